@@ -1,17 +1,209 @@
 from twisted.python import log
-from twisted.protocols.memcache import MemCacheProtocol
-from twisted.internet import protocol, reactor
-import random, time, hashlib, mail, traceback
+from twisted.internet import reactor, defer, threads
+import os, time, hashlib, struct, mmap, fcntl, zlib, marshal, mail, traceback, page, template
 try:
     import cPickle as pickle
 except ImportError:
     log.msg('cPickle not available, using slower pickle library.')
     import pickle
 
+def pack_strings(strings):
+    "Length-prefixed table of strings"
+    return struct.pack('!I%dI' % len(strings), len(strings), *[len(string) for string in strings]) + ''.join(strings)
+
+def unpack_strings(data, offset = 0):
+    count, = struct.unpack_from('!I', data, offset)
+    lengths = struct.unpack_from('!%dI' % count, data, offset + 4)
+    position = offset + 4 + 4 * count
+    strings = []
+    for length in lengths:
+        strings.append(data[position:position + length])
+        position += length
+    return strings
+
+class Tombstone(object):
+    "Cached in place of a value its backend does not have, so the miss is cached too"
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'TOMBSTONE'
+
+    def __reduce__(self):
+        return 'TOMBSTONE'
+
+    def __nonzero__(self):
+        return False
+
+TOMBSTONE = Tombstone()
+
+class PickleCodec:
+    "Stores values as pickles"
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        try:
+            return pickle.loads(str(data))
+        except:
+            log.msg('CACHE_BACKEND: Could not unpickle value, treating it as a miss')
+            return None
+
+class BinaryCodec:
+    """Stores values in a versioned binary format.
+
+    Pages are a fixed size header, a table of string lengths and the strings
+    themselves, with the body last.  Since version 3 the compiled template
+    and its dependencies are stored marshalled, so reading a page does not
+    parse its template again.  Strings, numbers and dicts and lists of them
+    are stored as a type character followed by their data.  Anything else is
+    pickled.  Values with another magic or a newer version are misses.
+    """
+
+    magic = 'TW'
+    version = 3
+    # Fixed size page header of each version
+    page_formats = {
+        1: '!HdiHHHB',
+        2: '!HdiHHHBd',     # adds fetch_time
+        3: '!HdiHHHBd',     # template nodes and dependencies are marshalled
+    }
+
+    def encode(self, value):
+        return '%s%s%s' % (self.magic, chr(self.version), self.pack(value))
+
+    def decode(self, data):
+        if data[:2] != self.magic or data[2:3] not in [chr(version) for version in self.page_formats]:
+            return None
+        try:
+            return self.unpack(data[3:], ord(data[2]))
+        except:
+            log.msg('CACHE_BACKEND: Could not decode value:\n%s' % traceback.format_exc())
+            return None
+
+    def pack(self, value):
+        if isinstance(value, str):
+            return 's' + value
+        elif isinstance(value, page.Page):
+            return 'P' + self.pack_page(value)
+        elif isinstance(value, bool):
+            return value and 'b1' or 'b0'
+        elif isinstance(value, (int, long)):
+            return 'i%d' % value
+        elif isinstance(value, float):
+            return 'f' + repr(value)
+        elif isinstance(value, unicode):
+            return 'u' + value.encode('utf-8')
+        elif isinstance(value, dict):
+            items = []
+            for key, val in value.iteritems():
+                items.append(self.pack(key))
+                items.append(self.pack(val))
+            return 'd' + pack_strings(items)
+        elif isinstance(value, list):
+            return 'l' + pack_strings([self.pack(val) for val in value])
+        elif value is None:
+            return 'n'
+        elif value is TOMBSTONE:
+            return 't'
+        else:
+            return 'p' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def unpack(self, data, version):
+        kind = data[0]
+        if kind == 's':
+            return data[1:]
+        elif kind == 'P':
+            return self.unpack_page(data, 1, version)
+        elif kind == 'b':
+            return data[1] == '1'
+        elif kind == 'i':
+            return int(data[1:])
+        elif kind == 'f':
+            return float(data[1:])
+        elif kind == 'u':
+            return data[1:].decode('utf-8')
+        elif kind == 'd':
+            items = [self.unpack(item, version) for item in unpack_strings(data, 1)]
+            return dict(zip(items[::2], items[1::2]))
+        elif kind == 'l':
+            return [self.unpack(item, version) for item in unpack_strings(data, 1)]
+        elif kind == 'n':
+            return None
+        elif kind == 't':
+            return TOMBSTONE
+        elif kind == 'p':
+            return pickle.loads(data[1:])
+        raise ValueError('Unknown type %s' % repr(kind))
+
+    def pack_page(self, value):
+        nodes = value.template or []
+        if value.gzip is None:
+            gzip_kind, gzip = 0, []
+        elif isinstance(value.gzip, str):
+            gzip_kind, gzip = 1, [value.gzip]
+        else:
+            gzip_kind, gzip = 2, list(value.gzip)
+        strings = [value.message or '', value.protocol or '']
+        for hkey, hval in value.headers:
+            strings.append(hkey)
+            strings.append(str(hval))
+        strings.extend(value.cookies)
+        dependencies = value.dependencies
+        if dependencies is None:
+            dependencies = template.dependencies(nodes)
+        strings.append(marshal.dumps((list(nodes), list(dependencies))))
+        strings.extend(gzip)
+        strings.append(value.body)
+        return struct.pack(self.page_formats[self.version], value.status, value.rendered_on, value.cache_control,
+            len(value.headers), len(value.cookies), len(nodes), gzip_kind, value.fetch_time or 0) + pack_strings(strings)
+
+    def unpack_page(self, data, offset, version):
+        page_format = self.page_formats[version]
+        fields = struct.unpack_from(page_format, data, offset)
+        status, rendered_on, cache_control, header_count, cookie_count, node_count, gzip_kind = fields[:7]
+        strings = unpack_strings(data, offset + struct.calcsize(page_format))
+        value = page.Page(None, rendered_on, cache_control)
+        if version >= 2:
+            value.fetch_time = fields[7]
+        value.status = status
+        value.message = strings[0] or None
+        value.protocol = strings[1]
+        position = 2 + header_count * 2
+        value.headers = tuple(zip(strings[2:position:2], strings[3:position:2]))
+        value.cookies = tuple(strings[position:position + cookie_count])
+        position += cookie_count
+        if version >= 3:
+            value.template, value.dependencies = marshal.loads(strings[position])
+            position += 1
+        else:
+            value.template = self.parse_nodes(strings[position:position + node_count], strings[position + node_count])
+            position += node_count + 1
+        if gzip_kind == 1:
+            value.gzip = strings[position]
+        elif gzip_kind == 2:
+            value.gzip = strings[position:position + node_count + 1]
+        value.body = strings[-1]
+        return value
+
+    def parse_nodes(self, expressions, offsets):
+        "Template nodes of a version 1 or 2 page, parsed from their expressions"
+        offsets = struct.unpack('!%dI' % (len(expressions) * 2), offsets)
+        nodes = []
+        for index, expression in enumerate(expressions):
+            try:
+                command, target, args, filters = template.parse(expression)
+            except:
+                command, target, args, filters = None, None, [], []
+            nodes.append((offsets[index * 2], offsets[index * 2 + 1], command, target, args, filters, expression))
+        return nodes
+
 class Cache:
     
     def __init__(self, config):
         self.config = config
+        self.codec = globals()[config.get('cache_codec', 'binary').capitalize() + 'Codec']()
         
     def ready(self):
         "Call when the cache is online"
@@ -25,49 +217,119 @@ class Cache:
         "Retreive a list of values as a python dict"
         return {}
         
+# Fields of an InternalCache entry
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+def approximate_size(value):
+    "Rough number of bytes used by a cached value"
+    if isinstance(value, basestring):
+        return len(value) + 40
+    elif isinstance(value, dict):
+        return 140 + sum([approximate_size(k) + approximate_size(v) for k, v in value.iteritems()])
+    elif isinstance(value, (list, tuple, set)):
+        return 60 + sum([approximate_size(v) for v in value])
+    elif hasattr(value, '__dict__'):
+        return 60 + approximate_size(value.__dict__)
+    elif hasattr(value, '__slots__'):
+        return 60 + sum([approximate_size(getattr(value, name, None)) for name in value.__slots__])
+    else:
+        return 24
+
 class InternalCache(Cache):
+    "In-process LRU cache holding at most limit MB (approximately)"
+
+    sweep_interval = 30.0
     
-    def __init__(self, config):
+    def __init__(self, config, limit = None):
         Cache.__init__(self, config)
-        self.cache = {}
+        if limit is None:
+            limit = config.get('cache_memory_limit')
+        if limit is None:
+            # Leave the rest of memory_limit for the process itself
+            limit = config.get('memory_limit') and float(config['memory_limit']) / 2
+        if not limit:
+            log.msg('WARNING: memory_limit not specified, using 100MB as default')
+            limit = 100
+        self.limit = float(limit)
+        self.max_bytes = int(self.limit * 1024 * 1024)
+        self.evictions = 0
+        self.flush()
         self.ready()
+        reactor.callLater(self.sweep_interval, self.sweep)
         
     def ready(self):
-        limit = self.config.get('memory_limit')
-        if not limit:
-            log.msg('WARNING: memory_limit not specified, using 100MB as default')
-        log.msg("CACHE_BACKEND: Using %s MB in-memory cache" % limit)
+        log.msg("CACHE_BACKEND: Using %s MB in-memory cache" % self.limit)
         
-    def set(self, dictionary, time = None):
-        for key, val in dict(dictionary.items()):
-            element = {
-                'expires_on' : time.time() + (time or 0),
-                'element' : val
-            }
-            dictionary[key] = element
-        self.cache.update(element)
+    def set(self, dictionary, ttl = None):
+        "Set all values that are not None, evicting the least recently used entries"
+        now = time.time()
+        for key, val in dictionary.items():
+            if val is None:
+                continue
+            self._unlink(key)
+            size = approximate_size(key) + approximate_size(val)
+            if size > self.max_bytes:
+                continue
+            # Insert as the most recently used entry
+            last = self.root[PREV]
+            entry = [last, self.root, key, val, size, ttl and now + ttl or 0]
+            last[NEXT] = self.root[PREV] = self.cache[key] = entry
+            self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._unlink(self.root[NEXT][KEY])
+            self.evictions += 1
             
     def get(self, keylist):
         if not isinstance(keylist, list): keylist = [keylist]
+        now = time.time()
         output = {}
         for key in keylist:
-            element = self.cache.get(key)
-            if element:
-                if time.time() > element['expires_on']:
-                    output[key] = None
-                else:
-                    output[key] = element['element']
+            entry = self.cache.get(key)
+            if entry is None:
+                output[key] = None
+            elif entry[EXPIRES] and now > entry[EXPIRES]:
+                self._unlink(key)
+                output[key] = None
+            else:
+                # Move to the most recently used position
+                entry[PREV][NEXT] = entry[NEXT]
+                entry[NEXT][PREV] = entry[PREV]
+                last = self.root[PREV]
+                entry[PREV], entry[NEXT] = last, self.root
+                last[NEXT] = self.root[PREV] = entry
+                output[key] = entry[VALUE]
         return output
         
     def delete(self, keylist):
+        if not isinstance(keylist, list): keylist = [keylist]
         for key in keylist:
-            try:
-                del self.cache[key]
-            except:
-                pass
+            self._unlink(key)
         
+    def stats(self):
+        return {'keys': len(self.cache), 'bytes': self.bytes, 'evictions': self.evictions}
+
     def flush(self):
         self.cache = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0, 0]
+        self.bytes = 0
+
+    def sweep(self):
+        "Drop every expired entry"
+        now = time.time()
+        expired = [key for key, entry in self.cache.iteritems() if entry[EXPIRES] and now > entry[EXPIRES]]
+        for key in expired:
+            self._unlink(key)
+        if expired:
+            log.msg('CACHE_BACKEND: Swept %s expired keys (%s keys, %.2f MB in use)' % (len(expired), len(self.cache), self.bytes / 1048576.0))
+        reactor.callLater(self.sweep_interval, self.sweep)
+
+    def _unlink(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            entry[PREV][NEXT] = entry[NEXT]
+            entry[NEXT][PREV] = entry[PREV]
+            self.bytes -= entry[SIZE]
         
 class PythonmemcacheCache(Cache):
 
@@ -75,7 +337,6 @@ class PythonmemcacheCache(Cache):
         Cache.__init__(self, config)
         servers = config['cache_server'].split(',')
         pool_size = int(config.get('cache_pool', 1))
-        reactor.suggestThreadPoolSize(500)
         log.msg('Creating memcache connections to servers %s...' % ','.join(servers))
         try:
             import mc
@@ -84,7 +345,10 @@ class PythonmemcacheCache(Cache):
             log.msg(traceback.format_exc())
             return
         try:
-            self.mc = mc.Mc(servers)
+            self.mc = mc.client(servers, config)
+            if isinstance(self.mc, mc.Mc):
+                # Every blocking memcache call takes a thread
+                reactor.suggestThreadPoolSize(500)
             self.ready(servers)
         except:
             log.msg('Failed ot create memcache object!')
@@ -94,9 +358,9 @@ class PythonmemcacheCache(Cache):
 
     def set(self, dictionary, time = None):
         "Set all values that are not None"
-        pickled_dict = dict([(hashlib.md5(key).hexdigest(), pickle.dumps(val)) for key, val in dictionary.items() if val is not None])
-        if len(pickled_dict):
-            return self.mc.set_multi(pickled_dict, time)
+        encoded_dict = dict([(hashlib.md5(key).hexdigest(), self.codec.encode(val)) for key, val in dictionary.items() if val is not None])
+        if len(encoded_dict):
+            return self.mc.set_multi(encoded_dict, time)
         else:
             return {}
 
@@ -104,78 +368,485 @@ class PythonmemcacheCache(Cache):
         'Get values'
         if not isinstance(keylist, list): keylist = [keylist]
         md5list = [hashlib.md5(key).hexdigest() for key in keylist]
-        return self.mc.get_multi(md5list).addCallback(self._format, keylist, md5list)
+        d = self.mc.get_multi(md5list)
+        d.addErrback(self._unavailable)
+        return d.addCallback(self._format, keylist, md5list)
 
     def delete(self, keylist):
         if not isinstance(keylist, list): keylist = [keylist]
         md5list = [hashlib.md5(key).hexdigest() for key in keylist]
         self.mc.delete_multi(md5list)
         
+    def _unavailable(self, failure):
+        "Keys on servers that are down are cache misses"
+        import mc
+        failure.trap(mc.McUnavailable)
+        return failure.value.found
+
     def _format(self, results, keylist, md5list):
         "Return a dictionary containing all keys in keylist, with cache misses as None"
-        output = dict([(key, results.get(md5) and pickle.loads(results[md5])) for key, md5 in zip(keylist, md5list)])
+        output = dict([(key, results.get(md5) and self.codec.decode(results[md5])) for key, md5 in zip(keylist, md5list)])
         #log.msg('Memcache results:\n%s' % repr(output))
         return output
 
     def flush(self):
         log.msg('ERROR: Unsupport operation flush() on PythonMemcacheCache')
         
-class MemcacheCache(Cache):
+class MemcacheCache(PythonmemcacheCache):
+    "Memcache servers on a consistent hash ring, with cache_pool connections to each"
 
     def __init__(self, config):
         Cache.__init__(self, config)
-        server = config['cache_server'].split(',')[0]
-        connection_pool_size = int(config.get('cache_pool', 1))
-        log.msg('Creating memcache connection pool to server %s...' % server)
-        self.pool = []
-        try:
-            self.host, self.port = server.split(':')
-        except:
-            self.host = server
-            self.port = 11211
-        for i in xrange(connection_pool_size):
-            d = protocol.ClientCreator(reactor, MemCacheProtocol).connectTCP(self.host, int(self.port))
-            d.addCallback(self.ready)
-
-    def ready(self, result=None):
-        log.msg("CACHE_BACKEND: Connected to memcache server at %s:%s" % (self.host, self.port))
-        self.pool.append(result)
-        
-    def cache_pool(self):
-        return random.choice(self.pool)
+        servers = config['cache_server'].split(',')
+        pool_size = int(config.get('cache_pool', 1))
+        log.msg('Creating memcache connection pools to servers %s...' % ','.join(servers))
+        import mc
+        self.mc = mc.AsyncMc(servers, float(config.get('memcache_timeout', 1.0)), pool_size, 'ketama')
+        self.ready(servers)
 
-    def set(self, dictionary, time = None):
-        "Set all values that are not None"
-        pickled_dict = dict([(hashlib.md5(key).hexdigest(), pickle.dumps(val)) for key, val in dictionary.items() if val is not None])
-        cache = self.cache_pool()
-        #log.msg('SET on cache %s' % cache)
-        if len(pickled_dict):
-            return cache.set_multi(pickled_dict, expireTime = time)
-        else:
-            return {}
+    def flush(self):
+        return self.mc.flush_all()
+
+class SharedmemoryCache(Cache):
+    """Cache in a memory mapped file shared by all Twice processes on a host.
+
+    The file holds one table of fixed size slots per entry in slot_sizes.  A
+    value is stored in the table with the smallest slots it fits in, in one
+    of the ways slots of the set its key hashes to, replacing the entry
+    written longest ago when the set is full.  Writers lock the set with
+    fcntl.  Readers take no lock, they retry when the slot's sequence number
+    is odd (being written) or changed while they copied the value.
+    """
+
+    magic = 'TWSHM'
+    version = 1
+    header_size = 4096
+    slot_sizes = (1024, 4096, 16384, 65536, 262144, 1048576)
+    ways = 8
+    # sequence number, md5 of the key, expiry time, write time, value length
+    slot_format = '!I16sddI'
+    retries = 3
+    empty = '\0' * 16
+
+    def __init__(self, config):
+        Cache.__init__(self, config)
+        # Workers of one instance share the file, other instances on the host get their own
+        self.path = config.get('cache_shm_path', '/dev/shm/twice-cache-%s' % config.get('port', 0))
+        self.size = int(float(config.get('cache_shm_size', 64)) * 1024 * 1024)
+        self.slot_header = struct.calcsize(self.slot_format)
+        # (slot size, offset, number of sets) of each table
+        self.tables = []
+        share = (self.size - self.header_size) / len(self.slot_sizes)
+        offset = self.header_size
+        for slot_size in self.slot_sizes:
+            sets = share / (slot_size * self.ways)
+            if sets:
+                self.tables.append((slot_size, offset, sets))
+                offset += sets * slot_size * self.ways
+        self.evictions = 0
+        self.open()
+        self.ready()
+
+    def ready(self):
+        log.msg("CACHE_BACKEND: Using %.1f MB shared memory cache in %s" % (self.size / 1048576.0, self.path))
+
+    def open(self):
+        """Map the cache file, replacing it if another layout is found.
+
+        A file in another layout may still be mapped by other processes, which
+        would crash if it shrank under them, so it is unlinked rather than
+        truncated and a new file is created in its place.
+        """
+        header = '%s %s %s %s %r' % (self.magic, self.version, self.size, self.ways, self.tables)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            fcntl.lockf(fd, fcntl.LOCK_EX, self.header_size, 0)
+            try:
+                if not os.path.exists(self.path) or os.stat(self.path).st_ino != os.fstat(fd).st_ino:
+                    # Replaced by another process while we waited for the lock
+                    continue
+                size = os.fstat(fd).st_size
+                if not size:
+                    log.msg('CACHE_BACKEND: Initializing shared memory cache %s' % self.path)
+                    os.ftruncate(fd, self.size)
+                    os.write(fd, header)
+                elif size != self.size or os.read(fd, len(header)) != header:
+                    log.msg('CACHE_BACKEND: Replacing shared memory cache %s in another layout (%.1f MB)' % (self.path, size / 1048576.0))
+                    os.unlink(self.path)
+                    continue
+                self.fd, fd = fd, None
+                self.map = mmap.mmap(self.fd, self.size)
+                return
+            finally:
+                if fd is not None:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, self.header_size, 0)
+                    os.close(fd)
+                else:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, self.header_size, 0)
+
+    def set(self, dictionary, ttl = None):
+        "Set all values that are not None and fit in the largest slots"
+        now = time.time()
+        for key, val in dictionary.items():
+            if val is None:
+                continue
+            data = self.codec.encode(val)
+            table = self.table(len(data))
+            if table is None:
+                continue
+            digest = hashlib.md5(key).digest()
+            # A resized value may still be in another table
+            for other in self.tables:
+                if other is not table:
+                    self._remove(other, digest)
+            self._write(table, digest, data, ttl and now + ttl or 0, now)
 
     def get(self, keylist):
-        'Get values'
         if not isinstance(keylist, list): keylist = [keylist]
-        md5list = [hashlib.md5(key).hexdigest() for key in keylist]
-        #log.msg('keylist: %s' % keylist)
-        cache = self.cache_pool()
-        #log.msg('GET on cache %s' % cache)
-        return cache.get_multi(md5list).addCallback(self._format, keylist, md5list)
-        
+        now = time.time()
+        output = {}
+        for key in keylist:
+            output[key] = self._read(hashlib.md5(key).digest(), now)
+        return output
+
     def delete(self, keylist):
+        if not isinstance(keylist, list): keylist = [keylist]
         for key in keylist:
-            self.cache_pool().delete(hashlib.md5(key).hexdigest())
-        
-    def _format(self, results, keylist, md5list):
-        "Return a dictionary containing all keys in keylist, with cache misses as None"
-        output = dict([(key, results[1].get(md5) and pickle.loads(results[1][md5])) for key, md5 in zip(keylist, md5list)])
-        #log.msg('Memcache results:\n%s' % repr(output))
+            digest = hashlib.md5(key).digest()
+            for table in self.tables:
+                self._remove(table, digest)
+
+    def flush(self):
+        for table in self.tables:
+            slot_size, offset, sets = table
+            for index in xrange(sets):
+                start = offset + index * slot_size * self.ways
+                self._lock(start, slot_size * self.ways)
+                try:
+                    for way in xrange(self.ways):
+                        self._clear(start + way * slot_size)
+                finally:
+                    self._unlock(start, slot_size * self.ways)
+
+    def stats(self):
+        return {'bytes': self.size, 'evictions': self.evictions}
+
+    def table(self, length):
+        "Table with the smallest slots a value of length bytes fits in"
+        for table in self.tables:
+            if self.slot_header + length <= table[0]:
+                return table
+        return None
+
+    def _set_start(self, table, digest):
+        slot_size, offset, sets = table
+        index, = struct.unpack('!Q', digest[8:])
+        return offset + (index % sets) * slot_size * self.ways
+
+    def _read(self, digest, now):
+        for table in self.tables:
+            slot_size = table[0]
+            start = self._set_start(table, digest)
+            for way in xrange(self.ways):
+                position = start + way * slot_size
+                if self.map[position + 4:position + 20] != digest:
+                    continue
+                for attempt in xrange(self.retries):
+                    seq, found, expires, written, length = struct.unpack_from(self.slot_format, self.map, position)
+                    if found != digest:
+                        return None
+                    if seq & 1 or length > slot_size - self.slot_header:
+                        continue
+                    data = self.map[position + self.slot_header:position + self.slot_header + length]
+                    if struct.unpack_from('!I', self.map, position)[0] == seq:
+                        if expires and now > expires:
+                            return None
+                        return self.codec.decode(data)
+                return None
+        return None
+
+    def _write(self, table, digest, data, expires, now):
+        slot_size = table[0]
+        start = self._set_start(table, digest)
+        self._lock(start, slot_size * self.ways)
+        try:
+            match = free = oldest = None
+            for way in xrange(self.ways):
+                position = start + way * slot_size
+                seq, found, found_expires, written, length = struct.unpack_from(self.slot_format, self.map, position)
+                if found == digest:
+                    match = position
+                    break
+                elif found == self.empty or (found_expires and now > found_expires):
+                    if free is None:
+                        free = position
+                elif oldest is None or written < oldest[1]:
+                    oldest = (position, written)
+            if match is not None:
+                position = match
+            elif free is not None:
+                position = free
+            else:
+                position = oldest[0]
+                self.evictions += 1
+            # An odd sequence number tells readers the slot is being written
+            seq = struct.unpack_from('!I', self.map, position)[0] | 1
+            struct.pack_into('!I', self.map, position, seq)
+            struct.pack_into('!16sddI', self.map, position + 4, digest, expires, now, len(data))
+            self.map[position + self.slot_header:position + self.slot_header + len(data)] = data
+            struct.pack_into('!I', self.map, position, (seq + 1) & 0xffffffff)
+        finally:
+            self._unlock(start, slot_size * self.ways)
+
+    def _remove(self, table, digest):
+        slot_size = table[0]
+        start = self._set_start(table, digest)
+        for way in xrange(self.ways):
+            position = start + way * slot_size
+            if self.map[position + 4:position + 20] == digest:
+                self._lock(start, slot_size * self.ways)
+                try:
+                    if self.map[position + 4:position + 20] == digest:
+                        self._clear(position)
+                finally:
+                    self._unlock(start, slot_size * self.ways)
+
+    def _clear(self, position):
+        "Empty a slot, the caller holds the lock of its set"
+        seq = struct.unpack_from('!I', self.map, position)[0] | 1
+        struct.pack_into('!I', self.map, position, seq)
+        self.map[position + 4:position + 20] = self.empty
+        struct.pack_into('!I', self.map, position, (seq + 1) & 0xffffffff)
+
+    def _lock(self, start, length):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, length, start)
+
+    def _unlock(self, start, length):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, length, start)
+
+class DiskCache(Cache):
+    """Cache in an append-only log on local disk, a bigger but slower tier.
+
+    Values are appended to a memory mapped file of cache_disk_size MB, and an
+    index in memory points the md5 of each key at its latest record.  Each
+    worker of each instance has its own log, locked while it is open.  When
+    the log is full, or more than
+    half of it is dead, the live records are copied to a new log in a
+    thread, dropping the oldest ones if they would fill more than half of
+    it, and the new log replaces the old one once it is complete.  Values
+    that do not fit while a compaction runs are not stored.  Each record
+    carries a checksum, so the index is rebuilt from the log on startup.
+
+    Tombstones and values cached for less than cache_disk_min_ttl seconds
+    are not worth a disk write and are left to the faster tiers.
+    """
+
+    magic = 'TWDC'
+    # magic, crc32, md5 of the key, expiry time (-1 for deletions), value length
+    record_format = '!4sI16sdI'
+    sweep_interval = 60.0
+
+    def __init__(self, config):
+        Cache.__init__(self, config)
+        directory = config.get('cache_disk_path', '/var/cache/twice')
+        self.path = os.path.join(directory, 'cache-%s-%s.log' % (config.get('port', 0), config.get('worker', 0)))
+        self.size = int(float(config.get('cache_disk_size', 1024)) * 1024 * 1024)
+        self.min_ttl = int(config.get('cache_disk_min_ttl', 60))
+        self.record_size = struct.calcsize(self.record_format)
+        self.compacting = None
+        self.compactions = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.open()
+        self.ready()
+        reactor.callLater(self.sweep_interval, self.sweep)
+
+    def ready(self):
+        log.msg("CACHE_BACKEND: Using %.1f MB disk cache in %s (%s keys loaded)" % (self.size / 1048576.0, self.path, len(self.index)))
+
+    def open(self):
+        "Map the log and rebuild the index from its records"
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(self.fd)
+            raise IOError('Disk cache %s is in use by another process' % self.path)
+        if os.fstat(self.fd).st_size != self.size:
+            os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+        self.index = {}
+        self.live = 0
+        position = 0
+        while position + self.record_size <= self.size:
+            magic, crc, digest, expires, length = struct.unpack_from(self.record_format, self.map, position)
+            end = position + self.record_size + length
+            if magic != self.magic or end > self.size or \
+              zlib.crc32(buffer(self.map, position + 8, end - position - 8)) & 0xffffffff != crc:
+                break
+            self._forget(digest)
+            if expires >= 0:
+                self.index[digest] = (position, length, expires)
+                self.live += end - position
+            position = end
+        self.end = position
+
+    def set(self, dictionary, ttl = None):
+        "Append all values that are not None"
+        now = time.time()
+        for key, val in dictionary.items():
+            if val is None:
+                continue
+            if val is TOMBSTONE or (ttl and ttl < self.min_ttl):
+                # An older copy on disk must not outlive the new value
+                self.delete(key)
+                continue
+            data = self.codec.encode(val)
+            if self.record_size + len(data) > self.size / 4:
+                continue
+            digest = hashlib.md5(key).digest()
+            self._forget(digest)
+            expires = ttl and now + ttl or 0
+            position = self._append(digest, expires, data)
+            if position is not None:
+                self.index[digest] = (position, len(data), expires)
+                self.live += self.record_size + len(data)
+
+    def get(self, keylist):
+        if not isinstance(keylist, list): keylist = [keylist]
+        output = {}
+        for key in keylist:
+            data = self._read(key)
+            if data is None:
+                output[key] = None
+            else:
+                output[key] = self.codec.decode(data)
         return output
-        
+
+    def _read(self, key):
+        "Buffer of the encoded value of key in the log, or None"
+        digest = hashlib.md5(key).digest()
+        entry = self.index.get(digest)
+        if entry is None:
+            return None
+        position, length, expires = entry
+        if expires and time.time() > expires:
+            self._forget(digest)
+            return None
+        return buffer(self.map, position + self.record_size, length)
+
+    def delete(self, keylist):
+        if not isinstance(keylist, list): keylist = [keylist]
+        for key in keylist:
+            digest = hashlib.md5(key).digest()
+            if digest in self.index:
+                self._forget(digest)
+                # Keep the key deleted when the index is rebuilt
+                self._append(digest, -1, '')
+
     def flush(self):
-        self.cache_pool().flushAll()
-        
+        self.index = {}
+        self.live = 0
+        self.compact()
+
+    def stats(self):
+        return {'keys': len(self.index), 'bytes': self.end, 'live_bytes': self.live,
+            'compactions': self.compactions, 'evictions': self.evictions}
+
+    def sweep(self):
+        "Drop expired keys, and compact the log once most of it is dead"
+        now = time.time()
+        for digest, (position, length, expires) in self.index.items():
+            if expires and now > expires:
+                self._forget(digest)
+        if self.end > self.size / 2 and self.live < self.end / 2:
+            self.compact()
+        reactor.callLater(self.sweep_interval, self.sweep)
+
+    def compact(self):
+        "Copy the live records to a new log in a thread, unless a compaction is running"
+        if self.compacting is None:
+            now = time.time()
+            records = sorted([(position, length, digest, expires) for digest, (position, length, expires) in self.index.iteritems()
+                if not expires or now <= expires])
+            total = sum([self.record_size + length for position, length, digest, expires in records])
+            while records and total > self.size / 2:
+                total -= self.record_size + records.pop(0)[1]
+                self.evictions += 1
+            self.compacting = threads.deferToThread(self._copy, self.map, records)
+            self.compacting.addCallback(self._swap, self.end)
+            self.compacting.addErrback(self._compactFailed)
+        return self.compacting
+
+    def _copy(self, old_map, records):
+        "Write records of old_map to a new log file and return it with their new positions"
+        fd = os.open(self.path + '.new', os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+        os.ftruncate(fd, self.size)
+        new_map = mmap.mmap(fd, self.size)
+        moved = {}
+        end = 0
+        for position, length, digest, expires in records:
+            record_length = self.record_size + length
+            new_map[end:end + record_length] = old_map[position:position + record_length]
+            moved[position] = (end, digest)
+            end += record_length
+        return fd, new_map, moved, end
+
+    def _swap(self, result, copied_end):
+        "Replace the log with the compacted one, adding what changed meanwhile"
+        fd, new_map, moved, end = result
+        index = {}
+        for digest, (position, length, expires) in self.index.iteritems():
+            record_length = self.record_size + length
+            if position in moved:
+                index[digest] = (moved[position][0], length, expires)
+            elif position >= copied_end and end + record_length <= self.size:
+                new_map[end:end + record_length] = self.map[position:position + record_length]
+                index[digest] = (end, length, expires)
+                end += record_length
+            else:
+                self.evictions += 1
+        # Keep keys deleted since the copy deleted when the index is rebuilt
+        for position, (new_position, digest) in moved.iteritems():
+            if digest not in index and end + self.record_size <= self.size:
+                self._write(new_map, end, digest, -1, '')
+                end += self.record_size
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(self.path + '.new', self.path)
+        # The old mapping is unmapped once nothing refers to it any more
+        os.close(self.fd)
+        self.fd, self.map, self.index, self.end = fd, new_map, index, end
+        self.live = sum([self.record_size + length for position, length, expires in index.itervalues()])
+        self.compacting = None
+        self.compactions += 1
+        log.msg('CACHE_BACKEND: Compacted disk cache to %s keys (%.1f MB)' % (len(index), end / 1048576.0))
+
+    def _compactFailed(self, failure):
+        self.compacting = None
+        log.msg('CACHE_BACKEND: Could not compact disk cache: %s' % failure.getErrorMessage())
+
+    def _append(self, digest, expires, data):
+        "Write a record at the end of the log and return its position, or None if it is full"
+        if self.end + self.record_size + len(data) > self.size:
+            self.compact()
+            return None
+        position = self.end
+        self._write(self.map, position, digest, expires, data)
+        self.end += self.record_size + len(data)
+        return position
+
+    def _write(self, log_map, position, digest, expires, data):
+        body = struct.pack('!16sdI', digest, expires, len(data))
+        crc = zlib.crc32(data, zlib.crc32(body)) & 0xffffffff
+        log_map[position:position + self.record_size] = self.magic + struct.pack('!I', crc) + body
+        log_map[position + self.record_size:position + self.record_size + len(data)] = data
+
+    def _forget(self, digest):
+        entry = self.index.pop(digest, None)
+        if entry is not None:
+            self.live -= self.record_size + entry[1]
+
 class NullCache(Cache):
 
     def __init__(self, config):
@@ -197,4 +868,97 @@ class NullCache(Cache):
         
     def flush(self):
         pass
-        
\ No newline at end of file
+        
+class TieredCache(Cache):
+    "Small, short lived in-process cache in front of one or more other caches"
+
+    def __init__(self, config):
+        Cache.__init__(self, config)
+        tier_types = config.get('cache_tiers', 'pythonMemcache').split(',')
+        self.local_ttl = int(config.get('cache_local_ttl', 5))
+        self.backfill_ttl = int(config.get('cache_backfill_ttl', 60))
+        self.tiers = [InternalCache(config, int(config.get('cache_local_memory_limit', 32)))]
+        for tier_type in tier_types:
+            self.tiers.append(globals()[tier_type.strip().capitalize() + 'Cache'](config))
+        # Longest time each tier may keep a value (None for no limit)
+        self.ttls = [self.local_ttl] + [None for tier_type in tier_types]
+        self.hits = [0 for tier in self.tiers]
+        self.misses = 0
+        self.ready()
+
+    def ready(self):
+        log.msg("CACHE_BACKEND: Using tiered cache (%s)" % ' -> '.join([tier.__class__.__name__ for tier in self.tiers]))
+
+    def set(self, dictionary, time = None):
+        "Write values through to every tier"
+        for tier, ttl in zip(self.tiers, self.ttls):
+            if ttl and (not time or time > ttl):
+                tier.set(dictionary, ttl)
+            else:
+                tier.set(dictionary, time)
+
+    def get(self, keylist):
+        if not isinstance(keylist, list): keylist = [keylist]
+        return self._get(keylist, 0, {})
+
+    def delete(self, keylist):
+        if not isinstance(keylist, list): keylist = [keylist]
+        for tier in self.tiers:
+            tier.delete(keylist)
+
+    def flush(self):
+        for tier in self.tiers:
+            tier.flush()
+
+    def stats(self):
+        "Hits per tier and overall misses"
+        output = dict([('hits_%s_%s' % (level, tier.__class__.__name__), hits) for level, (tier, hits) in enumerate(zip(self.tiers, self.hits))])
+        output['misses'] = self.misses
+        output.update([('local_' + name, value) for name, value in self.tiers[0].stats().items()])
+        return output
+
+    def backfill(self, tier, found):
+        """Copy pages into a tier without a TTL limit, for as long as they stay usable.
+
+        How long other values had left in a slower tier is not known, so they
+        are not copied.
+        """
+        now = time.time()
+        for key, value in found.iteritems():
+            if isinstance(value, page.Page):
+                # Pages are not served past 3x their cache_control (see DataStore.valid_page)
+                ttl = min(self.backfill_ttl, int(value.rendered_on + value.cache_control * 3 - now))
+                if ttl > 0:
+                    tier.set({key: value}, ttl)
+
+    def _get(self, keylist, level, output):
+        d = defer.maybeDeferred(self.tiers[level].get, keylist)
+        d.addCallback(self._format, keylist, level, output)
+        return d
+
+    def _format(self, results, keylist, level, output):
+        "Collect hits from one tier and look for the remaining keys in the next"
+        found = {}
+        missing = []
+        for key in keylist:
+            value = results.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if found:
+            self.hits[level] += len(found)
+            output.update(found)
+            # Copy values into the faster tiers, without keeping them longer
+            # than the tier they were found in would have
+            for tier, ttl in zip(self.tiers[:level], self.ttls):
+                if ttl:
+                    tier.set(found, min(ttl, self.backfill_ttl))
+                else:
+                    self.backfill(tier, found)
+        if missing and level + 1 < len(self.tiers):
+            return self._get(missing, level + 1, output)
+        self.misses += len(missing)
+        for key in missing:
+            output[key] = None
+        return output
@@ -0,0 +1,62 @@
+import zlib, struct
+
+# Pages are gzipped once when they are cached.  A page without template tags
+# is stored as a complete gzip body.  A templated page is stored as one raw
+# deflate segment per piece of literal text between tags, each ending on a
+# byte boundary (Z_SYNC_FLUSH), so that the rendered values can be deflated
+# on their own and spliced in between them on every request.  The values of
+# one response share a compressor, with a full flush after each so none of
+# them refers back to data the literal segments put out of place.
+
+header = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+final_block = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+
+def deflate(data, level = 6):
+    "Raw deflate segment ending on a byte boundary, without a final block"
+    if not data:
+        return ''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def trailer(crc, size):
+    return struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+def gzip(data):
+    "Complete gzip body for data"
+    return ''.join([header, deflate(data), final_block, trailer(zlib.crc32(data), len(data))])
+
+def compile(body, nodes):
+    "Compress a page body with its compiled template"
+    if not nodes:
+        return gzip(body)
+    segments = []
+    position = 0
+    for node in nodes:
+        segments.append(deflate(body[position:node[0]]))
+        position = node[1]
+    segments.append(deflate(body[position:]))
+    return segments
+
+def render(body, nodes, compressed, evaluate):
+    "Gzipped equivalent of template.render(body, nodes, evaluate)"
+    if not nodes:
+        return compressed
+    output = [header]
+    compressor = zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    position = 0
+    for node, segment in zip(nodes, compressed):
+        literal = body[position:node[0]]
+        value = evaluate(node)
+        output.append(segment)
+        if value:
+            output.append(compressor.compress(value) + compressor.flush(zlib.Z_FULL_FLUSH))
+        crc = zlib.crc32(value, zlib.crc32(literal, crc))
+        size += len(literal) + len(value)
+        position = node[1]
+    literal = body[position:]
+    output.append(compressed[-1])
+    output.append(final_block)
+    output.append(trailer(zlib.crc32(literal, crc), size + len(literal)))
+    return ''.join(output)
@@ -3,7 +3,7 @@ from twisted.internet import reactor, defer, protocol
 from twisted.python import log
 import sys, urllib, time, re, traceback, os, time
 import cPickle as pickle
-import parser, storage, http, cache, mail
+import parser, storage, http, cache, mail, template, compress, stats, logs
 
 try:
     import GeoIP
@@ -66,9 +66,10 @@ class RequestHandler(http.HTTPRequestDispatcher):
     def __init__(self, config):
         # Caches and config
         self.config = config
-        
-        # Template format
-        self.specialization_re = re.compile(self.config['template_regex'])
+
+        # Persistent client connections
+        self.keepalive_timeout = float(config.get('keepalive_timeout', 15))
+        self.keepalive_requests = int(config.get('keepalive_requests', 100))
         
         # Language redirects
         self.allowed_languages = ['en', 'ko', 'hi', 'ma', 'ca', 'de', 'es', 'fr', 'it', 'nl', 'pt', 'pt-br', 'sk', 'tl', 'vi', 'ar', 'ru', 'zh-cn', 'zh-tw']
@@ -115,6 +116,22 @@ class RequestHandler(http.HTTPRequestDispatcher):
             connection.sendCode(200, ','.join(self.uniques.keys()))
             return
         
+        # Handle request for the per-uri dependency manifest
+        if 'live/dependencies' in request.uri:
+            lines = ['%s %s' % (uri, ','.join('%s_%s' % dependency for dependency in dependencies))
+                for uri, dependencies in sorted(self.store.uri_dependencies.items())]
+            connection.sendCode(200, '\n'.join(lines))
+            return
+        
+        # Handle request for counters and timings
+        if 'live/stats' in request.uri:
+            response = http.HTTPObject()
+            response.status = 200
+            response.setHeader('content-type', 'application/json')
+            response.body = stats.dump(self.store.stats())
+            connection.sendResponse(response)
+            return
+
         # Handle time requests
         if 'live/time' in request.uri:
             connection.sendCode(200, str(time.time()))
@@ -131,9 +148,8 @@ class RequestHandler(http.HTTPRequestDispatcher):
             response = http.HTTPObject()
             response.status = 302
             response.setHeader('Location', 'http://%s.mydomain.com%s' % (lang, request.uri))
-            connection.transport.write(response.writeResponse())
-            connection.shutdown()
-            log.msg('REDIRECT: lang %s host %s -> http://%s.mydomain.com%s' % (lang, host, lang, request.uri))
+            connection.sendResponse(response)
+            logs.info('redirect', 'REDIRECT: lang %s host %s -> http://%s.mydomain.com%s', lang, host, lang, request.uri)
 
         # Check cache
         else:
@@ -156,9 +172,15 @@ class RequestHandler(http.HTTPRequestDispatcher):
             if session_key:
                 keys.append(session_key)
 
+            # Look the page up in the same round trip, guessing its key from
+            # the last response for this uri
+            prefetched = {}
+            speculative = self.store.speculate_page(request)
+
             # Retrieve keys
-            log.msg('PREFETCH: %s' % keys)
-            self.store.get(keys, request).addCallback(self.getPage, connection, request)
+            logs.debug('prefetch', 'PREFETCH: %s (speculative %s)', keys, speculative)
+            d = self.store.get(keys, request, prefetched=prefetched, speculative=speculative)
+            stats.timed(d, 'prefetch').addCallback(self.getPage, connection, request, prefetched)
             
 # ---------- CACHE EXPIRATION -----------
             
@@ -209,30 +231,30 @@ class RequestHandler(http.HTTPRequestDispatcher):
         return matches and matches[0]
 
 
-    def getPage(self, elements, connection, request):
+    def getPage(self, elements, connection, request, prefetched=None):
         # Set the abvalue we get on the request
         abvalue = self.find_prefix(elements, 'abvalue_')
         abvalue_string = ','.join('%s:%s' % (k, v) for k, v in abvalue.iteritems())
-        log.msg("Saving abvalue header %s: %s" % (self.config.get('abvalue_header'), repr(abvalue_string)))
+        logs.debug('abvalue', "Saving abvalue header %s: %r", self.config.get('abvalue_header'), abvalue_string)
         request.setHeader(self.config.get('abvalue_header'), abvalue_string)
 
         # hash the page to the appropriate abgroup
         abdependency = self.find_prefix(elements, 'abdependency_') or []
         page_key = self.store.hash_page(request, abvalue = abvalue, abdependency = abdependency)
 
-        self.store.get(page_key, request).addCallback(self.checkPage, connection, request, elements)
+        d = self.store.get(page_key, request, prefetched=prefetched)
+        stats.timed(d, 'page').addCallback(self.checkPage, connection, request, elements, prefetched)
         
 
-    def checkPage(self, elements, connection, request, extra = {}):
+    def checkPage(self, elements, connection, request, extra = {}, prefetched=None):
         "See if we have the correct version of the page"       
         elements.update(extra)         
 
         rkey, rval = self.find_prefix(elements, 'page_', include_key=True)
-        if 'response' not in rval:
+        if not rval:
             connection.sendCode(408, 'Request timed out.')
             return True
-        response = rval['response']
-        cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
+        cookies = sorted((rval.getHeader(self.config.get('cookies_header')) or '').split(','))
 
         # Extract the abdependency and abvalue if we have one
         abdependency = self.find_prefix(elements, 'abdependency_') or []
@@ -243,14 +265,16 @@ class RequestHandler(http.HTTPRequestDispatcher):
         # If the page we fetched doesn't have the right cookies or ab_values, try again!
         if key != self.store.hash_page(request, abdependency = abdependency, abvalue = abvalue):
             del elements[rkey]
-            return self.store.get(key, request).addCallback(self.scanPage, connection, request, elements)
+            d = self.store.get(key, request, prefetched=prefetched)
+            return stats.timed(d, 'variant').addCallback(self.scanPage, connection, request, elements)
                     
         # If the page is expired, request a new copy
         expire_time = self.find_prefix(elements, 'expiration_')
-        if expire_time and rval['rendered_on'] < expire_time:
-            log.msg('EXPIRED: rendered_on %s, expire_time %s' % (rval['rendered_on'], expire_time))
+        if expire_time and rval.rendered_on < expire_time:
+            logs.info('expired', 'EXPIRED: rendered_on %s, expire_time %s', rval.rendered_on, expire_time)
             del elements[rkey]
-            return self.store.get(key, request, force=True).addCallback(self.checkPage, connection, request, elements)
+            d = self.store.get(key, request, force=True)
+            return stats.timed(d, 'expired').addCallback(self.checkPage, connection, request, elements)
         
         return self.scanPage(elements, connection, request)
 
@@ -259,35 +283,28 @@ class RequestHandler(http.HTTPRequestDispatcher):
         "Scan for missing elements"
         elements.update(extra)
         logged_in = self.find_prefix(elements, 'session_') is not None
-        data = self.find_prefix(elements, 'page_')['response'].body
-        matches = self.specialization_re.findall(data)
+        dependencies = self.store.page_dependencies(self.find_prefix(elements, 'page_'))
         missing_keys = []
-        for match in matches:
-            # Parse element
-            try:
-                parts = match.strip().split()
-                command = parts[0].lower()
-                element_type = parts[1].lower()
-                element_id = parts[2]
-            except:
-                mail.error('Error in scanPage:\n%s' % traceback.format_exc())
-                continue
-            log.msg("Matched element (%s %s %s)" % (command, element_type, element_id))
+        debug = logs.enabled(logs.DEBUG, 'element')
+        for element_type, element_id in dependencies:
+            if debug:
+                logs.output('Matched element (%s %s)', element_type, element_id)
             if element_type not in request_actions:
                 if element_type in key_fetch_actions or element_type in hash_fetch_actions or logged_in:
                     key = self.store.elementHash(request, element_type, element_id)
                     if key and key not in missing_keys:
                         missing_keys.append(key)
         if missing_keys:
-            log.msg("Fetching missing keys %s" % repr(missing_keys))
+            logs.debug('element', 'Fetching missing keys %r', missing_keys)
             d = self.store.get(missing_keys, request)
-            d.addCallback(self.renderPage, connection, request, elements)
+            stats.timed(d, 'elements').addCallback(self.renderPage, connection, request, elements)
         else:
             self.renderPage({}, connection, request, elements)
 
     def renderPage(self, new_elements, connection, request, elements):
         global session_actions, key_fetch_actions, hash_fetch_actions
         "Write the page out to the request's connection"
+        started = time.time()
         elements.update(new_elements)
         # unread must come after session
         for etype in ['page'] + session_actions + hash_fetch_actions:
@@ -300,25 +317,34 @@ class RequestHandler(http.HTTPRequestDispatcher):
             #log.msg('Current %s: %s' % (etype, eitems))
 
         for etype in key_fetch_actions:
-            log.msg('elements: %s' % elements.items())
             eitems = dict((self.store.elementId(key), val) for key, val in elements.iteritems() if key.startswith(etype))
             setattr(self, 'current_' + etype, eitems)
-            log.msg('Current %s: %s' % (etype, eitems))
+            if logs.enabled(logs.DEBUG, 'elements'):
+                logs.output('Current %s: %r (of elements %r)', etype, eitems, elements)
         
         self.current_geo = GeoLookup(request, connection)
         self.current_ip  = IpLookup(request, connection)
         
-        response = self.current_page['response']
+        response = self.current_page.response()
         # Do Templating
-        data = self.specialization_re.sub(self.specialize, response.body)
+        nodes = self.store.page_template(self.current_page)
+        compressed = self.current_page.gzip
+        if compressed is not None:
+            vary = response.getHeader('vary')
+            response.setHeader('vary', vary and '%s, Accept-Encoding' % vary or 'Accept-Encoding')
+        if compressed is not None and request.acceptsEncoding('gzip'):
+            data = compress.render(response.body, nodes, compressed, self.specialize)
+            response.setHeader('content-encoding', 'gzip')
+        else:
+            data = template.render(response.body, nodes, self.specialize)
         # Remove current stuff
         for etype in session_actions:
             setattr(self, 'current_' + etype, {})
         # Log
-        app_server = response.getHeader('x-app-server') or 'unknown'
-        log.msg('RENDER %s [%s] (%.3fs from %s)' % (response.status, request.uri, (time.time() - request.received_on), app_server.strip()))
+        if logs.enabled(logs.INFO, 'render'):
+            app_server = response.getHeader('x-app-server') or 'unknown'
+            logs.output('RENDER %s [%s] (%.3fs from %s)', response.status, request.uri, time.time() - request.received_on, app_server.strip())
         # Overwrite headers
-        response.setHeader('connection', 'close')
         response.setHeader('content-length', len(data))
         response.setHeader('via', 'Twice %s %s:%s' % (self.config['version'], self.config['hostname'], self.config['port']))
         # Send geo along to user
@@ -335,26 +361,19 @@ class RequestHandler(http.HTTPRequestDispatcher):
         response.removeHeader(self.config.get('cookies_header'))
         response.removeHeader('x-app-server')
         # Write response
-        connection.transport.write(response.writeResponse(body = data))
-        connection.shutdown()
+        connection.sendResponse(response, body = data)
+        stats.since('render', started)
+        stats.since('request', request.received_on)
+        stats.incr('status.%s' % response.status)
         
 
 
 # ---------- TEMPLATING -----------
 
-    def specialize(self, expression):
-        "Parse an expression and return the result"
-        try:
-            expression = expression.groups()[0].strip()
-            parts = expression.split()
-            # Syntax is: command target arg1 arg2 argn
-            #   command - one of 'get', 'if', 'unless', 'incr', 'decr'
-            #   target - one of 'memcache', 'session'
-            #   arg[n] - usually the name of a key
-            command, target, args = parts[0].lower(), parts[1], parts[2:]
-            #log.msg('command: %s target: %s args: %s' % (command, target, repr(args)))
-        except:
-            mail.error('Could not parse expression: [%s]' % expression)
+    def specialize(self, node):
+        "Evaluate a compiled expression node and return the result"
+        start, end, command, target, args, filters, expression = node
+        if command is None:
             return expression
         # Grab dictionary
         try:
@@ -362,19 +381,6 @@ class RequestHandler(http.HTTPRequestDispatcher):
         except:
             dictionary = {}
         
-        actual_args = []
-        filters = []
-        
-        next_filter = False
-        for arg in args:
-            if arg == "|":
-                next_filter = True
-            elif next_filter:
-                filters.append(arg)
-            else:
-                actual_args.append(arg)
-        
-        args = actual_args
         return_val = None
         
         #log.msg('dictionary: %s' % dictionary)
@@ -1,7 +1,8 @@
 from twisted.python import log, failure
-from twisted.protocols import basic
+from twisted.protocols import policies
 from twisted.internet import protocol, defer, reactor
-import traceback, urllib, time, mail
+import traceback, urllib, time, copy, mail
+from collections import OrderedDict
 
 messages = {
     200 : 'OK',
@@ -18,34 +19,59 @@ messages = {
 
 timeout = 25.0
 
+# Headers that only apply to a single connection (RFC 2616 section 13.5.1)
+hop_by_hop_headers = ['connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade']
+
+def parseMaxAge(header):
+    "Parse headers looking like 'x-twice-control: max-age=23423'"
+    if header:
+        for element in header.split('; '):
+            if '=' in element:
+                key, val = element.split('=')[0:2]
+                if key == 'max-age':
+                    return int(val)
+    return None
+
 class HTTPObject:    
+
+    # Lower-cased cookie name -> value, parsed from cookies when first needed
+    cookie_map = None
     
     def __init__(self, id=None):
         self.id = id
-        self.headers = {}
+        # Lower-cased header name -> value, in the order they were received
+        self.headers = OrderedDict()
         self.cookies = []
         self.body = ''
         self.method = 'GET'
-        self.mode = 'status'
         self.uri = ''
         self.protocol = 'HTTP/1.0'
         self.status = 200
         self.message = None
-        self.element_cache = []
-        self.response = None
-        self.cacheable = False
-        self.elements = {}
         self.received_on = None
+        self.chunked = False
+        
+    def copy(self):
+        "Return a copy whose headers and cookies can be changed without affecting this object"
+        duplicate = copy.copy(self)
+        duplicate.headers = OrderedDict(self.headers)
+        duplicate.cookies = list(self.cookies)
+        return duplicate
         
     def setHeader(self, key, value=''):
-        self.removeHeader(key)
         self.headers[key.lower()] = value
         
     def getHeader(self, key):
-        for hkey, hval in self.headers.items():
-            if key.lower() == hkey.lower():
-                return hval
-        return None
+        return self.headers.get(key.lower())
+    
+    def acceptsEncoding(self, encoding):
+        "Whether the accept-encoding header allows encoding"
+        for coding in (self.getHeader('accept-encoding') or '').lower().split(','):
+            parts = [part.strip() for part in coding.split(';')]
+            if parts[0] in (encoding, 'x-' + encoding, '*'):
+                return 'q=0' not in parts and 'q=0.0' not in parts
+        return False
     
     def getRemoteIp(self, connection):
         ip = self.getHeader("True-Client-IP") or self.getHeader('X-Forwarded-For') or self.getHeader("X-Real-Ip") or connection.transport.getPeer().host
@@ -57,38 +83,38 @@ class HTTPObject:
         return ip
 
     def getCacheControlHeader(self, header='x-twice-control'):
-        "Parse headers looking like 'x-twice-control: max-age=23423'"
-        header = self.getHeader(header)
-        if header:
-            for element in header.split('; '):
-                if '=' in element:
-                    key, val = element.split('=')[0:2]
-                    if key == 'max-age':
-                        return int(val)
-        return None
+        return parseMaxAge(self.getHeader(header))
         
     def removeHeader(self, key):
-        for k in list(self.headers.keys()):
-            if key.lower() == k.lower():
-                del self.headers[k]
+        self.headers.pop(key.lower(), None)
+
+    def removeHopHeaders(self):
+        "Remove the headers that only applied to the connection this was received on"
+        listed = [name.strip() for name in (self.getHeader('connection') or '').split(',')]
+        for name in hop_by_hop_headers + listed:
+            if name:
+                self.removeHeader(name)
         
     def addCookie(self, key, value, path='/'):
         cookie = "%s=%s; path=%s" % (key, value, path)
         self.cookies.append(cookie)
+        self.cookie_map = None
     
     def removeCookie(self, key):
-        for cookie in list(self.cookies):
-            k, v, path = cookie
-            if key.lower() == k:
-                cookies.remove(cookie)
+        self.cookies = [cookie for cookie in self.cookies if cookie.split('; ')[0].split('=')[0].lower() != key.lower()]
+        self.cookie_map = None
+
+    def clearCookies(self):
+        self.cookies = []
+        self.cookie_map = None
                 
     def getCookie(self, key):
-        for cookie in self.cookies:
-            parts = cookie.split('; ')[0].split('=')
-            ckey, cval = parts[0], parts[1:]
-            if ckey.lower() == key.lower():
-                return '='.join(cval)
-        return None
+        if self.cookie_map is None:
+            self.cookie_map = {}
+            for cookie in self.cookies:
+                parts = cookie.split('; ')[0].split('=')
+                self.cookie_map.setdefault(parts[0].lower(), '='.join(parts[1:]))
+        return self.cookie_map.get(key.lower())
     
     def writeStatus(self):
         status_data = '%s %s %s\r\n' % (self.protocol, self.status, self.message or messages.get(self.status, 'ERROR'))
@@ -123,105 +149,258 @@ class HTTPObject:
         return ''.join([self.writeCommand(), self.writeHeaders(), self.writeCookies('cookie'), '\r\n', body or self.body])
 
         
-class HTTPHandler(basic.LineReceiver):
+class HTTPHandler(protocol.Protocol):
+
+    # Methods that start a request (anything else is parsed as a response)
+    methods = ['GET', 'PUT', 'POST', 'DELETE', 'HEAD']
 
     def __init__(self):
         self.max_headers = 100
+        self.max_header_size = 65536
         self.object_count = 0
         self.object = None 
         self.received_on = None
         self.active = True
+        self.paused = False
+        self.processing = False
+        self.buffer = ''        # data not parsed yet
+        self.body = []          # body chunks of the current object
+        self.remaining = 0      # body bytes still expected
+        self.state = 'headers'  # headers, body, chunk-size, chunk-end or trailers
         
     def connectionMade(self):
         self.received_on = time.time()   
-        
-    def lineReceived(self, line):
+
+    def dataReceived(self, data):
         if not self.active: return
-        #log.msg('Line: %s' % repr(line))
-        if not self.object:
-            self.object = HTTPObject(self.object_count)
-            self.object.received_on = self.received_on
-            self.object_count += 1
-        #log.msg('mode: %s' % self.request.mode)
+        self.buffer += data
+        self.processBuffer()
+
+    def pauseProducing(self):
+        "Stop parsing (and reading) until resumeProducing is called"
+        self.paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.transport.resumeProducing()
+        self.processBuffer()
+
+    def stopProducing(self):
+        self.transport.stopProducing()
+
+    def processBuffer(self):
+        if self.processing: return
+        self.processing = True
+        try:
+            while self.buffer and self.active and not self.paused:
+                if self.state == 'body':
+                    data, self.buffer = self.buffer[:self.remaining], self.buffer[self.remaining:]
+                    self.body.append(data)
+                    self.remaining -= len(data)
+                    if not self.remaining:
+                        if self.object.chunked:
+                            self.state = 'chunk-end'
+                        else:
+                            self.finishObject()
+                elif self.state == 'headers':
+                    # Tolerate blank lines between messages
+                    if self.buffer[:2] == '\r\n':
+                        self.buffer = self.buffer.lstrip('\r\n')
+                        continue
+                    end = self.buffer.find('\r\n\r\n')
+                    if end == -1:
+                        if len(self.buffer) > self.max_header_size:
+                            self.badObject('Header block is larger than %s bytes' % self.max_header_size)
+                        break
+                    block, self.buffer = self.buffer[:end], self.buffer[end + 4:]
+                    self.headersReceived(block)
+                elif self.state == 'chunk-size':
+                    end = self.buffer.find('\r\n')
+                    if end == -1:
+                        if len(self.buffer) > 1024:
+                            self.badObject('Chunk size line is too long')
+                        break
+                    line, self.buffer = self.buffer[:end], self.buffer[end + 2:]
+                    try:
+                        self.remaining = int(line.split(';')[0].strip(), 16)
+                    except ValueError:
+                        self.badObject('Bad chunk size %s' % repr(line))
+                        break
+                    self.state = self.remaining and 'body' or 'trailers'
+                elif self.state == 'chunk-end':
+                    if len(self.buffer) < 2:
+                        break
+                    if self.buffer[:2] != '\r\n':
+                        self.badObject('Chunk is longer than its size')
+                        break
+                    self.buffer = self.buffer[2:]
+                    self.state = 'chunk-size'
+                elif self.state == 'trailers':
+                    # Trailer headers are ignored
+                    if self.buffer[:2] == '\r\n':
+                        end = 0
+                    else:
+                        end = self.buffer.find('\r\n\r\n')
+                        if end == -1:
+                            if len(self.buffer) > self.max_header_size:
+                                self.badObject('Trailers are larger than %s bytes' % self.max_header_size)
+                            break
+                        end += 2
+                    self.buffer = self.buffer[end + 2:]
+                    self.finishObject()
+        finally:
+            self.processing = False
+
+    def headersReceived(self, block):
+        "Parse a status line and headers in one go"
+        lines = block.split('\r\n')
+        self.object = HTTPObject(self.object_count)
+        self.object.received_on = time.time()
+        self.object_count += 1
         
-        if self.object.mode == 'status':
-            try:
-                parts = line.split()
-                if parts[0].upper() in ['GET', 'PUT', 'POST', 'DELETE', 'HEAD']:
-                    self.object.method, self.object.uri, self.object.protocol = parts
-                    self.object.uri = self.object.uri
-                else:
-                    self.object.protocol = parts[0]
-                    self.object.status = int(parts[1])
-                    self.object.message = ' '.join(parts[2:])
-                self.object.mode = 'headers'
-                return
-            except:
-                mail.error("Bad line was: %s\n%s" % (line, traceback.format_exc()))
-                try:
-                    self.sendCode(400)
-                except:
-                    pass
-                self.shutdown()
+        try:
+            parts = lines[0].split()
+            if parts[0].upper() in self.methods:
+                self.object.method, self.object.uri, self.object.protocol = parts
+            else:
+                self.object.protocol = parts[0]
+                self.object.status = int(parts[1])
+                self.object.message = ' '.join(parts[2:])
+        except:
+            mail.error("Bad line was: %s\n%s" % (lines[0], traceback.format_exc()))
+            self.badObject('Bad status line')
+            return
+
+        if len(lines) - 1 > self.max_headers:
+            self.badObject('More than %s headers' % self.max_headers)
+            return
+        headers = self.object.headers
+        key = None
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and key:
+                # Continuation of the previous header
+                headers[key] = '%s %s' % (headers[key], line.strip())
+                continue
+            key, separator, value = line.partition(':')
+            if not separator:
+                self.badObject('Bad header line %s' % repr(line))
                 return
-                
-        elif self.object.mode == 'headers':
-            if line != '':
-                try:
-                    key, value = line.split(': ')
-                    if key.lower() == 'cookie':
-                        new_cookies = value.split('; ')
-                        self.object.cookies.extend(new_cookies)
-                        #log.msg('got request cookies %s' % new_cookies)
-                    elif key.lower() == 'set-cookie':
-                        new_cookie = value
-                        self.object.cookies.append(new_cookie)
-                        #log.msg('got reponse cookie %s' % new_cookie)
-                    else:
-                        self.object.setHeader(key, value)
-                except:
-                    self.sendCode(400)
-                    self.shutdown()
-                    return
+            key, value = key.strip().lower(), value.strip()
+            if key == 'cookie':
+                self.object.cookies.extend(value.split('; '))
+            elif key == 'set-cookie':
+                self.object.cookies.append(value)
             else:
-                #log.msg('Headers:\n%s' % repr(self.object.headers))
-                length = self.object.getHeader('content-length')
-                #log.msg('Got length of %s' % length)
-                if length and int(length) > 0:
-                    self.mode = 'body'
-                    self.setRawMode()
-                    #log.msg('Switched to binary mode!')
-                else:
-                    self.factory.objectReceived(self, self.object)
-                    self.object = None
-
-    def rawDataReceived(self, data):
-        if not self.active: return
-        #log.msg('got %s bytes:\n%s' % (len(data), repr(data)))
-        self.object.body += data
-        if len(self.object.body) == int(self.object.getHeader('content-length')):
-            #log.msg('Got full body!')
-            self.factory.objectReceived(self, self.object)
-            self.object = None
-            self.setLineMode()
+                headers[key] = value
+        
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.object.chunked = True
+            self.state = 'chunk-size'
+            return
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            self.badObject('Bad content-length %s' % repr(headers.get('content-length')))
+            return
+        if length > 0:
+            self.remaining = length
+            self.state = 'body'
         else:
-            pass
-            #log.msg('waiting on %s' % (int(self.object.getHeader('content-length')) - len(self.object.body)))
+            self.finishObject()
+
+    def finishObject(self):
+        received, self.object = self.object, None
+        self.state = 'headers'
+        if self.body:
+            received.body = ''.join(self.body)
+            self.body = []
+        if received.chunked:
+            # The body is passed on whole, so describe it with a length instead
+            received.removeHeader('transfer-encoding')
+            received.setHeader('content-length', len(received.body))
+            received.chunked = False
+        self.objectReceived(received)
+
+    def badObject(self, reason):
+        "Give up on a connection that sent something we can not parse"
+        log.msg('ERROR: Bad HTTP message (%s)' % reason)
+        self.active = False
+        self.buffer = ''
+        self.shutdown()
+
+    def objectReceived(self, received):
+        self.factory.objectReceived(self, received)
             
     def shutdown(self):
         self.transport.loseConnection()
                 
-class HTTPServer(HTTPHandler):
+class HTTPServer(HTTPHandler, policies.TimeoutMixin):
     
     def __init__(self):
         HTTPHandler.__init__(self)
+        self.persistent = False
+        self.method = None
+
+    def connectionMade(self):
+        HTTPHandler.connectionMade(self)
+        self.setTimeout(self.factory.keepalive_timeout or None)
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        HTTPHandler.connectionLost(self, reason)
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        HTTPHandler.dataReceived(self, data)
+
+    def objectReceived(self, request):
+        "Hold back any pipelined requests until this one has been answered"
+        self.setTimeout(None)
+        self.pauseProducing()
+        self.persistent = self.keepAlive(request)
+        self.method = request.method.upper()
+        HTTPHandler.objectReceived(self, request)
+
+    def badObject(self, reason):
+        log.msg('ERROR: Bad HTTP message (%s)' % reason)
+        self.active = False
+        self.buffer = ''
+        self.persistent = False
+        self.sendCode(400)
+
+    def keepAlive(self, request):
+        "Whether the connection should stay open after answering request"
+        if not self.factory.keepalive_timeout or self.object_count >= self.factory.keepalive_requests:
+            return False
+        connection = (request.getHeader('connection') or '').lower()
+        if request.protocol.upper() == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+    def sendResponse(self, response, body = None):
+        "Write response, then close the connection or wait for the next request"
+        if self.persistent:
+            # Proxies treat HTTP/1.0 responses as the end of the connection
+            response.protocol = 'HTTP/1.1'
+        response.setHeader('connection', self.persistent and 'keep-alive' or 'close')
+        data = response.writeResponse(body)
+        if self.method == 'HEAD':
+            # Responses to HEAD requests must not have a body
+            data = data[:len(data) - len(body or response.body)]
+        self.transport.write(data)
+        if self.persistent:
+            self.persistent = False
+            self.setTimeout(self.factory.keepalive_timeout)
+            self.resumeProducing()
+        else:
+            self.shutdown()
         
     def sendCode(self, code, body = ''):
         response = HTTPObject()
         response.status = int(code)
         response.body = body
-        self.transport.write(response.writeResponse())
-        self.shutdown()
+        self.sendResponse(response)
         
 class HTTPClient(HTTPHandler):
     
@@ -236,6 +415,11 @@ class HTTPClient(HTTPHandler):
 class HTTPRequestDispatcher(protocol.ServerFactory):
     
     protocol = HTTPServer
+
+    # Seconds an idle client connection is kept open (0 closes it after every response)
+    keepalive_timeout = 0
+    # Requests answered on one client connection before it is closed
+    keepalive_requests = 100
         
     def objectReceived(self, connection, request):
         "Override me"
@@ -267,3 +451,186 @@ class HTTPRequestSender(protocol.ClientFactory):
         "Send the page!"
         self.timeoutDeferred.cancel()
         self.deferred.callback(response)
+
+class HTTPPooledClient(HTTPHandler):
+    "Persistent connection to a backend server, owned by an HTTPConnectionPool"
+
+    # Methods that may be sent again if the connection closes before a response
+    retry_methods = ['GET', 'HEAD']
+
+    def __init__(self, pool):
+        HTTPHandler.__init__(self)
+        self.pool = pool
+        self.request = None
+        self.deferred = None
+        self.idle_since = None
+
+    def sendRequest(self, request, deferred):
+        self.request = request
+        self.deferred = deferred
+        self.idle_since = None
+        outgoing = request.copy()
+        outgoing.protocol = 'HTTP/1.1'
+        outgoing.removeHeader('keep-alive')
+        outgoing.setHeader('connection', 'keep-alive')
+        self.transport.write(outgoing.writeRequest())
+
+    def dataReceived(self, data):
+        if self.deferred is None and self.request is None:
+            # A healthy backend sends nothing on an idle connection
+            log.msg('Closing backend connection that sent data while idle')
+            self.shutdown()
+            return
+        HTTPHandler.dataReceived(self, data)
+
+    def keepAlive(self, response):
+        "Whether the backend will accept another request on this connection"
+        connection = (response.getHeader('connection') or '').lower()
+        if 'close' in connection or response.getHeader('content-length') is None:
+            return False
+        return response.protocol.upper() == 'HTTP/1.1' or 'keep-alive' in connection
+
+    def objectReceived(self, response):
+        deferred, self.deferred, self.request = self.deferred, None, None
+        if deferred is None or deferred.called:
+            # Nobody is waiting for this response any more
+            self.shutdown()
+            return
+        if self.keepAlive(response) and not self.buffer:
+            self.pool.release(self)
+        else:
+            self.shutdown()
+        deferred.callback(response)
+
+    def connectionLost(self, reason):
+        HTTPHandler.connectionLost(self, reason)
+        self.connected = 0
+        self.pool.lost(self, reason)
+
+class HTTPConnectionPool:
+    "Bounded set of persistent HTTP/1.1 connections to one backend server"
+
+    def __init__(self, host, port, size = 20, idle_timeout = 30.0):
+        self.host = host
+        self.port = port
+        self.address = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connections = 0        # connected or connecting
+        self.connecting = 0
+        self.idle = []              # connected clients waiting for a request
+        self.busy = []              # clients waiting for a response
+        self.queue = []             # (request, deferred) waiting for a connection
+        reactor.resolve(host).addCallbacks(self.resolved, self.resolveFailed)
+        reactor.callLater(self.idle_timeout, self.reap)
+
+    def __repr__(self):
+        return '<HTTPConnectionPool %s:%s (%s idle, %s busy, %s queued)>' % (self.host, self.port, len(self.idle), len(self.busy), len(self.queue))
+
+    def resolved(self, address):
+        log.msg('Resolved backend %s to %s' % (self.host, address))
+        self.address = address
+
+    def resolveFailed(self, reason):
+        log.msg('Could not resolve backend %s: %s' % (self.host, reason.getErrorMessage()))
+
+    def request(self, request):
+        "Send request to the backend and return a deferred firing with the response"
+        d = defer.Deferred()
+        timer = reactor.callLater(timeout, self.timedOut, request, d)
+        d.addBoth(self._cancelTimer, timer)
+        self.queue.append((request, d))
+        self.dispatch()
+        return d
+
+    def dispatch(self):
+        "Hand queued requests to idle connections, opening new ones as needed"
+        while self.queue:
+            client = self.checkout()
+            if client:
+                request, d = self.queue.pop(0)
+                self.busy.append(client)
+                client.sendRequest(request, d)
+            elif self.connections < self.size and len(self.queue) > self.connecting:
+                self.connect()
+            else:
+                break
+
+    def checkout(self):
+        "Most recently used idle connection that is still open and not past idle_timeout"
+        cutoff = time.time() - self.idle_timeout
+        while self.idle:
+            client = self.idle.pop()
+            if client.connected and client.idle_since >= cutoff:
+                return client
+            client.shutdown()
+        return None
+
+    def connect(self):
+        self.connections += 1
+        self.connecting += 1
+        d = protocol.ClientCreator(reactor, HTTPPooledClient, self).connectTCP(self.address, self.port, timeout)
+        d.addCallbacks(self.connected, self.connectFailed)
+
+    def connected(self, client):
+        self.connecting -= 1
+        self.release(client)
+
+    def connectFailed(self, reason):
+        self.connecting -= 1
+        self.connections -= 1
+        log.msg('ERROR: Could not connect to backend %s:%s (%s)' % (self.host, self.port, reason.getErrorMessage()))
+        # Fail a waiting request rather than leaving it to time out
+        if self.queue:
+            request, d = self.queue.pop(0)
+            d.errback(reason)
+        self.dispatch()
+
+    def release(self, client):
+        "Return a connection to the idle list"
+        if client in self.busy:
+            self.busy.remove(client)
+        client.idle_since = time.time()
+        self.idle.append(client)
+        self.dispatch()
+
+    def lost(self, client, reason):
+        "Forget a closed connection, retrying its request if nothing was received"
+        self.connections -= 1
+        if client in self.idle:
+            self.idle.remove(client)
+        if client in self.busy:
+            self.busy.remove(client)
+        d, request = client.deferred, client.request
+        client.deferred = client.request = None
+        if d is not None and not d.called:
+            if client.object is None and not client.buffer and client.object_count and request.method.upper() in client.retry_methods:
+                # The backend closed a reused connection before answering
+                self.queue.insert(0, (request, d))
+            else:
+                d.errback(reason)
+        self.dispatch()
+
+    def timedOut(self, request, d):
+        "The request took too long!"
+        if (request, d) in self.queue:
+            self.queue.remove((request, d))
+        for client in self.busy:
+            if client.deferred is d:
+                client.deferred = client.request = None
+                client.shutdown()
+        d.errback(failure.Failure(TimeoutError("Request for %s timed out (%ss)" % (request.uri, timeout))))
+
+    def reap(self):
+        "Close connections that have been idle for too long"
+        cutoff = time.time() - self.idle_timeout
+        for client in list(self.idle):
+            if not client.connected or client.idle_since < cutoff:
+                self.idle.remove(client)
+                client.shutdown()
+        reactor.callLater(self.idle_timeout, self.reap)
+
+    def _cancelTimer(self, result, timer):
+        if timer.active():
+            timer.cancel()
+        return result
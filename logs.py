@@ -0,0 +1,84 @@
+from twisted.python import log
+import random
+
+# Leveled and sampled logging for the request path.  Messages are only
+# formatted when they are going to be written, so disabled debug output
+# costs a function call.  Call sites whose arguments take work to compute
+# check enabled() first and then write with output().
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+level = INFO
+sampling = {}   # category -> fraction of its messages to write
+
+def configure(config):
+    "Read log_level and log_sample (category:rate,...) from config"
+    global level
+    level = levels.get(str(config.get('log_level', 'info')).lower(), INFO)
+    sampling.clear()
+    for item in (config.get('log_sample') or '').split(','):
+        if ':' in item:
+            category, rate = item.split(':')
+            sampling[category.strip()] = float(rate)
+
+def enabled(message_level, category = None):
+    "Whether a message would be written (sampled categories pass at their rate)"
+    if message_level < level:
+        return False
+    rate = sampling.get(category)
+    return rate is None or random.random() < rate
+
+def write(message_level, category, message, *args):
+    if enabled(message_level, category):
+        output(message, *args)
+
+def output(message, *args):
+    "Write a message that enabled() already allowed"
+    if args:
+        message = message % args
+    log.msg(message)
+
+def debug(category, message, *args):
+    write(DEBUG, category, message, *args)
+
+def info(category, message, *args):
+    write(INFO, category, message, *args)
+
+def warning(category, message, *args):
+    write(WARNING, category, message, *args)
+
+def error(category, message, *args):
+    write(ERROR, category, message, *args)
+
+class BufferedLogObserver(log.FileLogObserver):
+    """Log observer that collects lines and writes them out in batches.
+
+    Lines are written when flush() is called (on a timer, see twice.Logger),
+    when max_lines are waiting, and right away for errors.
+    """
+
+    max_lines = 1000
+
+    def __init__(self, f):
+        log.FileLogObserver.__init__(self, f)
+        self.output = f
+        self.lines = []
+        self.write = self.lines.append
+        self.flush = self.checkLines
+
+    def emit(self, eventDict):
+        log.FileLogObserver.emit(self, eventDict)
+        if eventDict.get('isError'):
+            self.flushLines()
+
+    def checkLines(self):
+        if len(self.lines) >= self.max_lines:
+            self.flushLines()
+
+    def flushLines(self):
+        if self.lines:
+            data = ''.join(self.lines)
+            del self.lines[:]
+            self.output.write(data)
+            self.output.flush()
@@ -1,7 +1,32 @@
-from twisted.internet import defer, threads
+from twisted.internet import defer, threads, protocol, reactor
+from twisted.protocols.memcache import MemCacheProtocol, DEFAULT_PORT
 from twisted.python import threadable, log
 threadable.init(1)
-import traceback, sys, StringIO
+import traceback, sys, StringIO, binascii, zlib, hashlib, struct, bisect, random
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Value flags used by python-memcache, so both clients can read each other's values
+FLAG_PICKLE = 1
+FLAG_INTEGER = 2
+FLAG_LONG = 4
+FLAG_COMPRESSED = 8
+
+def client(urls, config):
+    "Memcache client for urls of the kind chosen by the memcache_client setting"
+    if config.get('memcache_client', 'async') == 'threaded':
+        return Mc(urls)
+    return AsyncMc(urls, float(config.get('memcache_timeout', 1.0)))
+
+class McUnavailable(Exception):
+    "Keys could not be read because their server is down or did not answer"
+
+    def __init__(self, keys, found = None):
+        Exception.__init__(self, 'Memcache unavailable for %s' % ', '.join(keys))
+        self.keys = keys
+        self.found = found or {}    # values read from the servers that answered
 
 class Mc:
     
@@ -34,6 +59,9 @@ class Mc:
     def get_multi(self, keys):
         return threads.deferToThread(self.doGetMulti, keys)
         
+    def add(self, key, value, time=0):
+        return threads.deferToThread(self.doAdd, key, value, time)
+
     def increment(self, key):
         return threads.deferToThread(self.doIncr, key)
 
@@ -48,6 +76,10 @@ class Mc:
         if self.enabled: self.connection.set_multi(mapping, time)
         return True
         
+    def doAdd(self, key, value, time):
+        if self.enabled: self.connection.add(key, value, time)
+        return True
+        
     def doDelete(self, key):
         if self.enabled: self.connection.delete(key)
         return True
@@ -74,3 +106,223 @@ class Mc:
     def doDecr(self, key):
         if self.enabled: self.connection.decr(key)
         return True
+
+class McProtocol(MemCacheProtocol):
+
+    def connectionMade(self):
+        MemCacheProtocol.connectionMade(self)
+        self.factory.connected(self)
+
+    def connectionLost(self, reason):
+        MemCacheProtocol.connectionLost(self, reason)
+        self.factory.lost(self)
+
+class McConnection(protocol.ReconnectingClientFactory):
+    "One connection to a memcache server, reconnecting with exponential backoff"
+
+    protocol = McProtocol
+    maxDelay = 30
+
+    def __init__(self, server):
+        self.server = server
+        reactor.connectTCP(server.host, server.port, self)
+
+    def buildProtocol(self, addr):
+        proto = self.protocol(self.server.timeout)
+        proto.factory = self
+        return proto
+
+    def connected(self, proto):
+        self.resetDelay()
+        self.server.connected(proto)
+
+    def lost(self, proto):
+        self.server.lost(proto)
+
+class McServer:
+    "Pool of connections to one memcache server"
+
+    def __init__(self, url, timeout, size=1, changed=None):
+        try:
+            self.host, port = url.split(':')
+            self.port = int(port)
+        except ValueError:
+            self.host, self.port = url, DEFAULT_PORT
+        self.name = '%s:%s' % (self.host, self.port)
+        self.timeout = timeout
+        self.changed = changed      # called when the server goes up or down
+        self.live = []              # connected protocols
+        self.pool = [McConnection(self) for i in xrange(size)]
+
+    def __repr__(self):
+        return '<McServer %s (%s of %s connections up)>' % (self.name, len(self.live), len(self.pool))
+
+    def connection(self):
+        "A connected protocol, or None if the server is down"
+        return self.live and random.choice(self.live) or None
+
+    def connected(self, proto):
+        self.live.append(proto)
+        if len(self.live) == 1:
+            log.msg('Connected to memcache server %s' % self.name)
+            if self.changed: self.changed(self)
+
+    def lost(self, proto):
+        if proto in self.live:
+            self.live.remove(proto)
+            if not self.live:
+                log.msg('Lost all connections to memcache server %s' % self.name)
+                if self.changed: self.changed(self)
+
+class HashRing:
+    "Ketama consistent hashing of keys onto servers"
+
+    def __init__(self, servers):
+        ring = []
+        for server in servers:
+            for i in xrange(40):
+                digest = hashlib.md5('%s-%d' % (server.name, i)).digest()
+                for point in struct.unpack('<4I', digest):
+                    ring.append((point, server.name, server))
+        ring.sort()
+        self.points = [point for point, name, server in ring]
+        self.servers = [server for point, name, server in ring]
+
+    def get(self, key):
+        "Server responsible for key, or None if there are no servers"
+        if not self.points:
+            return None
+        point, = struct.unpack('<I', hashlib.md5(key).digest()[:4])
+        return self.servers[bisect.bisect(self.points, point) % len(self.points)]
+
+class AsyncMc:
+    """Non-blocking memcache client for several servers.
+
+    Commands for one server are pipelined on its connections.  By default
+    keys are spread over the servers the same way python-memcache does it;
+    with the ketama distribution a consistent hash ring of the servers that
+    are up is used instead, so losing a server only moves its own keys.
+    Reads from a server that is down or times out fail with McUnavailable,
+    so they are not mistaken for misses; other commands return a default.
+    """
+
+    def __init__(self, urls, timeout=1.0, pool_size=1, distribution='modulo'):
+        self.ring = None
+        if distribution == 'ketama':
+            self.ring = HashRing([])
+        self.servers = [McServer(url.strip(), timeout, pool_size, self.serverChanged) for url in urls]
+
+    def serverChanged(self, server):
+        if self.ring is not None:
+            live = [s for s in self.servers if s.live]
+            self.ring = HashRing(live)
+            log.msg('Memcache hash ring now has %s of %s servers' % (len(live), len(self.servers)))
+
+    def server(self, key):
+        "Server responsible for key"
+        if self.ring is not None:
+            return self.ring.get(key)
+        return self.servers[(((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff) % len(self.servers)]
+
+    def group(self, keys):
+        "Map each server to the keys it is responsible for"
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.server(key), []).append(key)
+        return groups
+
+    def set(self, key, value, time=0):
+        return self._store('set', key, value, time)
+
+    def set_multi(self, mapping, time=0):
+        return defer.DeferredList([self._store('set', key, value, time) for key, value in mapping.items()]).addCallback(lambda results: True)
+
+    def add(self, key, value, time=0):
+        return self._store('add', key, value, time)
+
+    def delete(self, key):
+        return self._call(self.server(key), 'delete', False, key)
+
+    def delete_multi(self, keys):
+        return defer.DeferredList([self.delete(key) for key in keys]).addCallback(lambda results: True)
+
+    def get(self, key):
+        return self._call(self.server(key), 'get', None, key).addCallback(self._got, key)
+
+    def get_multi(self, keys):
+        "Return a dict of the keys that were found"
+        groups = self.group(keys).items()
+        deferreds = [self._call(server, 'getMultiple', None, server_keys) for server, server_keys in groups]
+        return defer.DeferredList(deferreds).addCallback(self._merge, groups)
+
+    def increment(self, key):
+        return self._call(self.server(key), 'increment', None, key)
+
+    def decrement(self, key):
+        return self._call(self.server(key), 'decrement', None, key)
+
+    def _store(self, command, key, value, time):
+        flags, data = self._encode(value)
+        return self._call(self.server(key), command, False, key, data, flags, time or 0)
+
+    def flush_all(self):
+        return defer.DeferredList([self._call(server, 'flushAll', False) for server in self.servers]).addCallback(lambda results: True)
+
+    def _call(self, server, command, default, *args):
+        "Run a command on server, returning default if it is down or the command fails"
+        connection = server and server.connection()
+        if connection is None:
+            return defer.succeed(default)
+        d = defer.maybeDeferred(getattr(connection, command), *args)
+        d.addErrback(self._failed, server, command, default)
+        return d
+
+    def _failed(self, failure, server, command, default):
+        log.msg('Memcache %s on %s failed: %s' % (command, server.name, failure.getErrorMessage()))
+        return default
+
+    def _got(self, result, key):
+        if result is None:
+            raise McUnavailable([key])
+        return self._decode(result)
+
+    def _merge(self, results, groups):
+        output = {}
+        unavailable = []
+        for (success, values), (server, server_keys) in zip(results, groups):
+            if not success or values is None:
+                unavailable.extend(server_keys)
+                continue
+            for key, value in values.iteritems():
+                value = self._decode(value)
+                if value is not None:
+                    output[key] = value
+        if unavailable:
+            raise McUnavailable(unavailable, output)
+        return output
+
+    def _encode(self, value):
+        if isinstance(value, str):
+            return 0, value
+        elif isinstance(value, bool):
+            return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        elif isinstance(value, int):
+            return FLAG_INTEGER, str(value)
+        elif isinstance(value, long):
+            return FLAG_LONG, str(value)
+        else:
+            return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, result):
+        flags, data = result
+        if data is None:
+            return None
+        if flags & FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        if flags & FLAG_PICKLE:
+            return pickle.loads(data)
+        elif flags & FLAG_INTEGER:
+            return int(data)
+        elif flags & FLAG_LONG:
+            return long(data)
+        return data
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+import http
+
+class Page(object):
+    "Compact record of a backend response as it is kept in the cache"
+
+    __slots__ = (
+        'status',           # HTTP status code
+        'message',          # status message sent by the backend
+        'protocol',         # protocol of the backend response
+        'headers',          # tuple of (lower-cased name, value) pairs
+        'cookies',          # tuple of set-cookie values (empty for cached pages)
+        'body',             # response body, still containing template tags
+        'rendered_on',      # when the backend rendered the page
+        'cache_control',    # seconds the page may be served from the cache
+        'template',         # compiled template (see template.py)
+        'dependencies',     # (element_type, element_id) pairs the template uses
+        'gzip',             # compressed body (see compress.py), or None
+        'fetch_time',       # seconds the backend took to produce the page
+    )
+
+    def __init__(self, response=None, rendered_on=0, cache_control=0):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if response is not None:
+            self.status = response.status
+            self.message = response.message
+            self.protocol = response.protocol
+            self.headers = tuple(response.headers.items())
+            self.cookies = tuple(response.cookies)
+            self.body = response.body
+        self.rendered_on = rendered_on
+        self.cache_control = cache_control
+
+    def __repr__(self):
+        return '<Page %s (%s bytes, rendered_on %s, cache_control %s)>' % (self.status, len(self.body or ''), self.rendered_on, self.cache_control)
+
+    def __getstate__(self):
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        # Pages pickled before a field was added leave it as None
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def copy(self):
+        "Copy that can be changed without affecting the instance other requests share"
+        duplicate = Page()
+        duplicate.__setstate__(self.__getstate__())
+        return duplicate
+
+    def get(self, name, default=None):
+        "Lets templates use <& get page ... &> on page metadata"
+        if name in self.__slots__:
+            return getattr(self, name)
+        return default
+
+    def getHeader(self, key):
+        key = key.lower()
+        for hkey, hval in self.headers:
+            if hkey == key:
+                return hval
+        return None
+
+    def getCacheControlHeader(self, header='x-twice-control'):
+        return http.parseMaxAge(self.getHeader(header))
+
+    def response(self):
+        "New HTTPObject that can be modified and written out to a client"
+        response = http.HTTPObject()
+        response.status = self.status
+        response.message = self.message
+        response.protocol = self.protocol
+        response.headers = OrderedDict(self.headers)
+        response.cookies = list(self.cookies)
+        response.body = self.body
+        return response
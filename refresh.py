@@ -0,0 +1,100 @@
+from twisted.internet import reactor, defer
+import time, random, http, logs
+
+# Fields of a RefreshScheduler entry
+HITS, LAST_HITS, REQUEST, SCHEDULED = range(4)
+
+class RefreshScheduler:
+    """Re-fetches popular pages shortly before they go stale.
+
+    Page hits are counted per page key over one minute windows.  A page that
+    got at least min_hits requests in the current or the last window is
+    re-fetched lead seconds (minus up to jitter seconds) before its
+    cache_control runs out.  Only the uri, the headers and the cookies its
+    page key depends on are kept from the request that scheduled it, and the
+    refresh request is rebuilt from them.  At most concurrency refreshes run
+    at once, the rest wait in a queue.
+    """
+
+    window = 60.0
+    # Headers the page key depends on, besides the abvalue_header
+    headers = ['host', 'x-real-host', 'accept-language']
+
+    def __init__(self, store, min_hits = 0, lead = 5.0, jitter = 2.0, concurrency = 10):
+        self.store = store
+        self.min_hits = min_hits
+        self.lead = lead
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.pages = {}
+        self.queue = []
+        self.active = 0
+        self.refreshes = 0
+        if self.min_hits:
+            reactor.callLater(self.window, self.decay)
+
+    def hit(self, key, request, value):
+        "Count a hit on a fresh cached page and schedule its refresh if it is hot"
+        if not self.min_hits:
+            return
+        entry = self.pages.get(key)
+        if entry is None:
+            entry = self.pages[key] = [0, 0, None, 0]
+        entry[HITS] += 1
+        expires = value.rendered_on + value.cache_control
+        if max(entry[HITS], entry[LAST_HITS]) < self.min_hits or entry[SCHEDULED] >= expires:
+            return
+        # Pages that expire this quickly would be refreshed all the time
+        if value.cache_control <= self.lead * 2:
+            return
+        entry[SCHEDULED] = expires
+        entry[REQUEST] = self.summarize(request, value)
+        delay = max(0, expires - self.lead - random.uniform(0, self.jitter) - time.time())
+        reactor.callLater(delay, self.refresh, key)
+
+    def refresh(self, key):
+        entry = self.pages.get(key)
+        if entry is None:
+            return
+        if self.active >= self.concurrency:
+            self.queue.append(key)
+            return
+        logs.info('refresh', 'REFRESH [%s]', key)
+        self.active += 1
+        self.refreshes += 1
+        d = defer.maybeDeferred(self.store.fetch_page, self.rebuild(entry[REQUEST]), key, True)
+        d.addBoth(self.done)
+
+    def summarize(self, request, value):
+        "The uri, headers and cookies of request that the key of page value depends on"
+        config = self.store.config
+        names = self.headers + [config.get('abvalue_header')]
+        headers = [(name, request.getHeader(name)) for name in names if name and request.getHeader(name) is not None]
+        names = (value.getHeader(config.get('cookies_header')) or '').split(',') + [config.get('ab_cookie')]
+        cookies = ['%s=%s' % (name, request.getCookie(name)) for name in names if name and request.getCookie(name) is not None]
+        return request.uri, headers, cookies
+
+    def rebuild(self, summary):
+        "GET request for a page from what summarize() kept"
+        uri, headers, cookies = summary
+        request = http.HTTPObject()
+        request.uri = uri
+        for name, value in headers:
+            request.setHeader(name, value)
+        request.cookies = list(cookies)
+        return request
+
+    def done(self, result):
+        self.active -= 1
+        if self.queue:
+            self.refresh(self.queue.pop(0))
+        return None
+
+    def decay(self):
+        "Start a new window, forgetting pages that got no hits in the last two"
+        for key, entry in self.pages.items():
+            if not entry[HITS] and not entry[LAST_HITS]:
+                del self.pages[key]
+            else:
+                entry[LAST_HITS], entry[HITS] = entry[HITS], 0
+        reactor.callLater(self.window, self.decay)
@@ -0,0 +1,67 @@
+import time, bisect, json
+
+# Process wide counters and latency histograms, served as JSON on live/stats
+
+# Upper bounds in seconds of the latency histogram buckets
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+started = time.time()
+counters = {}
+histograms = {}
+
+class Histogram:
+    "Count of timings per bucket, with their number, sum and maximum"
+
+    def __init__(self):
+        self.counts = [0 for bound in buckets] + [0]
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'buckets': zip(list(buckets) + ['+Inf'], self.counts),
+        }
+
+def incr(name, amount = 1):
+    counters[name] = counters.get(name, 0) + amount
+
+def timing(name, seconds):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.add(seconds)
+
+def since(name, start):
+    "Record the time elapsed since start under name"
+    timing(name, time.time() - start)
+
+def timed(d, name):
+    "Record the time until deferred d fires under name"
+    start = time.time()
+    def record(result):
+        since(name, start)
+        return result
+    return d.addBoth(record)
+
+def snapshot(gauges = None):
+    "All counters and histograms, with gauges supplied by the caller"
+    return {
+        'uptime': round(time.time() - started, 3),
+        'counters': counters,
+        'timings': dict([(name, histogram.snapshot()) for name, histogram in histograms.iteritems()]),
+        'gauges': gauges or {},
+    }
+
+def dump(gauges = None):
+    return json.dumps(snapshot(gauges), sort_keys = True)
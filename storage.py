@@ -2,11 +2,25 @@ from twisted.internet import reactor, protocol, defer
 from twisted.enterprise import adbapi
 from twisted.protocols.memcache import MemCacheProtocol, DEFAULT_PORT
 from twisted.python import log
-import traceback, urllib, time
-import cache, http, mail
+import traceback, urllib, time, re, math, collections
+import cache, http, mail, template, compress, page, refresh, stats, logs, mc
 import random # for ab testing
 import cPickle as pickle
 
+class BoundedDict(collections.OrderedDict):
+    "Dictionary that forgets the least recently set keys beyond limit"
+
+    def __init__(self, limit):
+        collections.OrderedDict.__init__(self)
+        self.limit = limit
+
+    def __setitem__(self, key, value):
+        if key in self:
+            collections.OrderedDict.__delitem__(self, key)
+        collections.OrderedDict.__setitem__(self, key, value)
+        while len(self) > self.limit:
+            self.popitem(last = False)
+
 class DataStore:
     # Status codes
     uncacheable_status = [500, 502, 503, 504, 304, 307]
@@ -16,6 +30,13 @@ class DataStore:
     def __init__(self, config):
         self.config = config   
 
+        # Template format
+        self.specialization_re = re.compile(self.config['template_regex'])
+
+        # Compression of cached pages
+        self.gzip = bool(config.get('gzip'))
+        self.gzip_min_length = int(config.get('gzip_min_length', 256))
+
         # Mecache Backend
         servers = config.get('backend_memcache').split(',')
         log.msg('Creating connections to backend_memcache servers %s...' % ','.join(servers))
@@ -26,7 +47,7 @@ class DataStore:
             log.msg(traceback.format_exc())
             return
         try:
-            self.proto = mc.Mc(servers)
+            self.proto = mc.client(servers, config)
             log.msg('backend_memcache OK')
         except:
             log.msg('Failed ot create memcache object!')
@@ -42,7 +63,7 @@ class DataStore:
             log.msg(traceback.format_exc())
             return
         try:
-            self.viewdb = mc.Mc(servers)
+            self.viewdb = mc.client(servers, config)
             log.msg('backend_viewdb OK')
         except:
             log.msg('Failed ot create memcache object!')
@@ -77,6 +98,8 @@ class DataStore:
         except:
             self.backend_host = self.config['backend_webserver']
             self.backend_port = 80
+        self.backend = http.HTTPConnectionPool(self.backend_host, self.backend_port,
+            int(config.get('backend_pool', 20)), float(config.get('backend_idle_timeout', 30)))
             
         # Cache Backend
         log.msg('Initializing cache...')
@@ -86,26 +109,90 @@ class DataStore:
         # Memorize variants of a uri
         self.uri_lookup = {}
 
-        # Request pileup queue
+        # Memorize the elements each cacheable uri depends on, for the most recent uris
+        self.uri_limit = int(config.get('uri_limit', 10000))
+        self.uri_dependencies = BoundedDict(self.uri_limit)
+
+        # Memorize the cookies and ab tests the last cacheable response for a path varied on
+        self.uri_variants = BoundedDict(self.uri_limit)
+
+        # Request pileup queue (page variant key -> requests waiting on the pending fetch)
         self.pending_requests = {}
+        self.coalesced_requests = 0
+
+        # Elements the backends do not have are remembered for a short while
+        self.negative_cache_ttl = int(config.get('negative_cache_ttl', 10))
+        self.tombstone_hits = 0
+
+        # Popular pages are refreshed before they go stale
+        self.refresher = refresh.RefreshScheduler(self,
+            int(config.get('refresh_min_hits', 0)),
+            float(config.get('refresh_lead', 5)),
+            float(config.get('refresh_jitter', 2)),
+            int(config.get('refresh_concurrency', 10)))
+
+        # Probabilistic early refresh of pages (0 disables)
+        self.xfetch_beta = float(config.get('xfetch_beta', 0))
     
     # Init status
 
+    def stats(self):
+        "Current sizes and totals of the data store and its cache"
+        gauges = {
+            'pending_requests': len(self.pending_requests),
+            'coalesced_requests': self.coalesced_requests,
+            'tombstone_hits': self.tombstone_hits,
+            'refreshes': self.refresher.refreshes,
+            'refreshes_active': self.refresher.active,
+            'refreshes_queued': len(self.refresher.queue),
+            'uris': len(self.uri_dependencies),
+        }
+        if hasattr(self.cache, 'stats'):
+            gauges.update([('cache.' + name, value) for name, value in self.cache.stats().items()])
+        return gauges
+
     def dbConnected(self, db):
         log.msg('Database connection success.')
         self.db = db
                     
     # Main methods
 
-    def get(self, keys, request, force=False):
+    def get(self, keys, request, force=False, prefetched=None, speculative=()):
+        """Look keys up in the cache and fetch misses.
+
+        Keys found in prefetched are not looked up again.  Speculative keys are
+        looked up in the same cache round trip and stored in prefetched as they
+        are, without fetching them if they miss.
+        """
         if not isinstance(keys, list): keys = [keys]
         if force:
             d = self.handleMisses(dict(zip(keys, [None for key in keys])), request)
         else:
-            d = defer.maybeDeferred(self.cache.get, keys)
+            if prefetched is None:
+                prefetched = {}
+            lookup = [key for key in keys if key not in prefetched]
+            lookup.extend([key for key in speculative if key not in lookup and key not in prefetched])
+            if lookup:
+                d = defer.maybeDeferred(self.cache.get, lookup)
+            else:
+                d = defer.succeed({})
+            d.addCallback(self.usePrefetched, keys, prefetched, speculative)
             d.addCallback(self.handleMisses, request)
             d.addErrback(self.getError)
         return d
+
+    def usePrefetched(self, results, keys, prefetched, speculative):
+        "Split speculative lookups off the cache results and fill in prefetched keys"
+        for key in speculative:
+            if key in results:
+                prefetched[key] = results[key]
+        output = {}
+        for key in keys:
+            if key in results:
+                output[key] = results[key]
+            else:
+                output[key] = prefetched.get(key)
+        return output
         
     def delete(self, keys):
         if not isinstance(keys, list): keys = [keys]
@@ -119,21 +206,38 @@ class DataStore:
         "Process hits, check for validity, and fetch misses / invalids"
         missing_deferreds = []
         missing_elements = []
+        batched = {}
         for key, value in dictionary.items():
             fetch = False
-            if value is None:
-                log.msg('MISS [%s]' % key)
+            if value is cache.TOMBSTONE:
+                logs.info('negative_hit', 'NEGATIVE HIT [%s]', key)
+                stats.incr('negative_hit.' + self.elementType(key))
+                self.tombstone_hits += 1
+                dictionary[key] = None
+            elif value is None:
+                logs.info('miss', 'MISS [%s]', key)
+                stats.incr('miss.' + self.elementType(key))
                 fetch = True
             elif not getattr(self, 'valid_' + self.elementType(key))(request, self.elementId(key), value):
-                log.msg('INVALID [%s]' % key)
+                logs.info('invalid', 'INVALID [%s]', key)
+                stats.incr('invalid.' + self.elementType(key))
                 fetch = True
             else:
-                log.msg('HIT [%s]' % key)
-            if fetch:
+                logs.info('hit', 'HIT [%s]', key)
+                stats.incr('hit.' + self.elementType(key))
+            if fetch and hasattr(self, 'fetch_multi_' + self.elementType(key)):
+                batched.setdefault(self.elementType(key), []).append(key)
+            elif fetch:
                 d = defer.maybeDeferred(getattr(self, 'fetch_' + self.elementType(key)), request, self.elementId(key))
                 d.addErrback(self.fetchError, key)
                 missing_deferreds.append(d)
                 missing_elements.append(key)
+        # Types that can be fetched in bulk get one request for all their keys
+        for element_type, keys in batched.items():
+            d = defer.maybeDeferred(getattr(self, 'fetch_multi_' + element_type), request, [self.elementId(key) for key in keys])
+            d.addErrback(self.fetchError, keys[0])
+            missing_deferreds.append(d)
+            missing_elements.append(keys)
         # Wait for all items to be fetched
         if missing_deferreds:
             deferredList = defer.DeferredList(missing_deferreds)
@@ -144,10 +248,27 @@ class DataStore:
         
     def returnElements(self, results, dictionary, missing_elements):
         if not isinstance(results, list): results = [results]
-        uncached_elements = dict([(key, results.pop(0)[1]) for key in missing_elements])
-        dictionary.update(uncached_elements)
+        for key in missing_elements:
+            value = results.pop(0)[1]
+            if isinstance(key, list):
+                # Bulk fetches return a dictionary of ids to values
+                for element_key in key:
+                    dictionary[element_key] = (value or {}).get(self.elementId(element_key))
+            else:
+                dictionary[key] = value
         return dictionary
 
+    def cache_elements(self, dictionary, time):
+        """Cache fetched elements, with a tombstone for the ones the backend does not have.
+
+        Only call this with the results of a fetch that succeeded: failed
+        reads (mc.McUnavailable) must not be remembered as missing keys.
+        """
+        self.cache.set(dict([(key, value) for key, value in dictionary.items() if value is not None]), time)
+        missing = [key for key, value in dictionary.items() if value is None]
+        if missing and self.negative_cache_ttl:
+            self.cache.set(dict([(key, cache.TOMBSTONE) for key in missing]), self.negative_cache_ttl)
+
     def fetchError(self, result, key):
         log.msg('Error calling fetch_%s for key %s' % (self.elementType(key), self.elementId(key)))
         log.msg(result.getErrorMessage().replace('\n', ' '))
@@ -212,143 +333,245 @@ class DataStore:
             # Update key based on cookies we care about
             if found_cookies:
                 key += '//' + ','.join(found_cookies)
-        log.msg("HASHED PAGE %s" % key)
+        logs.debug('hash', 'HASHED PAGE %s', key)
         return key
         
-    def fetch_page(self, request, id, ignoreResult=False):
-        # Prevent idental request pileup
-        key = self.hash_page(request)
-        if key in self.pending_requests and ignoreResult:
-            log.msg('PENDING: Request is already pending for %s' % request.uri)
-            return True
+    def variant_path(self, request):
+        "Key of uri_variants: pages under one path vary on the same cookies whatever the query"
+        return request.uri.split('?')[0]
+
+    def speculate_page(self, request):
+        "Page keys a request most likely resolves to, guessed from the last response for its path"
+        variant = self.uri_variants.get(self.variant_path(request))
+        if variant is None:
+            return []
+        cookies, abdependency = variant
+        # Keys that depend on ab tests need the abvalue, which is not known yet
+        if [test for test in abdependency if test]:
+            return []
+        keys = [self.hash_page(request, abdependency = abdependency)]
+        key = self.hash_page(request, cookies = cookies, abdependency = abdependency)
+        if key not in keys:
+            keys.append(key)
+        return keys
+
+    def coalesce_key(self, request):
+        "Page key of a request whose path last gave a cacheable response, None otherwise"
+        if request.method.upper() in self.uncacheable_methods:
+            return None
+        variant = self.uri_variants.get(self.variant_path(request))
+        if variant is None:
+            return None
+        cookies, abdependency = variant
+        return self.hash_page(request, cookies = cookies, abdependency = abdependency, abvalue = self.read_abvalue(request))
+
+    def fetch_page(self, request, id, ignoreResult=False, coalesce=True):
+        # Prevent idental request pileup, for pages known to be shared between requests
+        key = coalesce and self.coalesce_key(request)
+        if not key and ignoreResult and request.method.upper() not in self.uncacheable_methods:
+            # Nobody waits on background refreshes, but they are not repeated
+            key = self.hash_page(request)
+        if key and key in self.pending_requests:
+            if ignoreResult:
+                logs.info('coalesce', 'PENDING: Request is already pending for %s', request.uri)
+                return True
+            logs.info('coalesce', 'COALESCED: Waiting on pending request for %s', request.uri)
+            self.coalesced_requests += 1
+            waiter = defer.Deferred()
+            self.pending_requests[key].append((waiter, request))
+            return waiter
         # Tell backend that we are Twice and strip cache-control headers
         request.setHeader(self.config.get('twice_header'), 'true')
         request.removeHeader('cache-control')
+        # Requests for the same page that arrive meanwhile wait on this one
+        waiters = []
+        if key:
+            self.pending_requests[key] = waiters
         # Make the request
-        sender = http.HTTPRequestSender(request)
-        #sender.noisy = False
-        reactor.connectTCP(self.backend_host, self.backend_port, sender)
+        d = stats.timed(self.backend.request(request), 'backend')
         # Defer the result 
-        d = sender.deferred.addCallback(self.extract_page, request).addErrback(self.page_failed, request)
-        self.pending_requests[key] = d
+        d.addCallback(self.extract_page, request, waiters, time.time(), key).addErrback(self.page_failed, request, waiters, key)
         return d
         
     def valid_page(self, request, id, value):
         "Determine whether the page can be served from the cache"
         # Force refetch of very stale (3x cache_control value) pages
+        if not isinstance(value, page.Page):
+            logs.info('page', 'OUTDATED [%s]', id)
+            stats.incr('outdated.page')
+            return False
+        # Learn how the path varies from pages other processes fetched too
+        if request.method.upper() not in self.uncacheable_methods:
+            variant = self.page_variant(value)
+            if self.uri_variants.get(self.variant_path(request)) != variant:
+                self.uri_variants[self.variant_path(request)] = variant
         now = time.time()
-        if now > value['rendered_on'] + value['cache_control'] * 3:
-            log.msg('STALE-HARD [%s]' % id)
+        if now > value.rendered_on + value.cache_control * 3:
+            logs.info('page', 'STALE-HARD [%s]', id)
+            stats.incr('stale_hard.page')
             return False
         # Sevre semi-stale pages but refresh in the background
-        elif now > value['rendered_on'] + value['cache_control']:
-            log.msg('STALE-SOFT [%s]' % id)
+        elif now > value.rendered_on + value.cache_control:
+            logs.info('page', 'STALE-SOFT [%s]', id)
+            stats.incr('stale_soft.page')
 
             # Extend the valid cache length by 30s so we can fetch it
-            response = value['response']
-            cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
+            cookies = sorted((value.getHeader(self.config.get('cookies_header')) or '').split(','))
             key = self.hash_page(request, cookies = cookies)
-            cache_control = response.getCacheControlHeader(self.config.get('cache_header')) or 0
-            if response.status in self.uncacheable_status:
-                log.msg('NO-CACHE (Status is %s) [%s]' % (response.status, key))
-                cache = False
-            elif response.status in self.short_status:
-                log.msg('SHORT-CACHE (Status is %s) [%s]' % (response.status, key))
-                cache = True
-                cache_control = 30
-            elif cache_control and cache_control > 0:
-                log.msg('CACHE [%s] (for %ss)' % (key, cache_control))
-                cache = True
-            else:
-                log.msg('NO-CACHE (No cache data) [%s]' % key)
-                cache = False
-            value['rendered_on'] += 30
+            cache, cache_control = self.cache_policy(value, key)
             if cache:
-                self.cache.set({key : value}, 60) # Give 60s to refresh the page
+                # value may be shared through the in-process cache, so extend a copy
+                extended = value.copy()
+                extended.rendered_on += 30
+                self.cache.set({key : extended}, 60) # Give 60s to refresh the page
 
             # Now fetch a fresh copy in the background
             self.fetch_page(request, id, ignoreResult=True)
             return True
         # Do not serve cached versions of pages if the method is not cacheable
         elif request.method.upper() in self.uncacheable_methods:
-            log.msg('PASS-THROUGH [%s]' % request.method.upper())
+            logs.info('page', 'PASS-THROUGH [%s]', request.method.upper())
+            stats.incr('pass_through.page')
             return False
         # Valid page
         else:
+            if self.refresh_early(value, now):
+                logs.info('page', 'EARLY-REFRESH [%s]', id)
+                stats.incr('early_refresh.page')
+                self.fetch_page(request, id, ignoreResult=True)
+            self.refresher.hit(id, request, value)
             return True
+
+    def refresh_early(self, value, now):
+        """Whether to refresh a fresh page now (XFetch).
+
+        The chance grows as the page gets closer to going stale and with the
+        time the backend took to render it, so the Twice servers sharing a
+        cache do not all refresh a page at the same moment.
+        """
+        if not self.xfetch_beta or not value.fetch_time:
+            return False
+        return now - value.fetch_time * self.xfetch_beta * math.log(1.0 - random.random()) > value.rendered_on + value.cache_control
+
+    def cache_policy(self, response, key):
+        "Whether a backend response may be cached, and for how many seconds"
+        cache_control = response.getCacheControlHeader(self.config.get('cache_header')) or 0
+        if response.status in self.uncacheable_status:
+            logs.info('policy', 'NO-CACHE (Status is %s) [%s]', response.status, key)
+            return False, cache_control
+        elif response.status in self.short_status:
+            logs.info('policy', 'SHORT-CACHE (Status is %s) [%s]', response.status, key)
+            return True, 30
+        elif cache_control and cache_control > 0:
+            logs.info('policy', 'CACHE [%s] (for %ss)', key, cache_control)
+            return True, cache_control
+        else:
+            logs.info('policy', 'NO-CACHE (No cache data) [%s]', key)
+            return False, cache_control
         
-    def page_failed(self, response, request):
-        # Release pending lock
-        key = self.hash_page(request)
-        if key in self.pending_requests:
-            del self.pending_requests[key]
+    def release_page(self, pending, waiters):
+        "Release the pending lock taken by fetch_page"
+        if pending and self.pending_requests.get(pending) is waiters:
+            del self.pending_requests[pending]
+
+    def page_failed(self, response, request, waiters=(), pending=None):
+        self.release_page(pending, waiters)
         
         log.msg('ERROR: Could not retrieve [%s]' % request.uri.rstrip("?h"))
         response.printBriefTraceback()
+        # Requests waiting on this one fail the same way
+        for waiter, waiter_request in waiters:
+            waiter.errback(response)
         # TODO: Return something meaningful!
         return ''
-        
-    def extract_page(self, response, request):
-        # Release pending lock
-        key = self.hash_page(request)
-        if key in self.pending_requests:
-            del self.pending_requests[key]
-        
-        # Extract uniqueness info
-        cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
 
-        # Extract AB test dependencies
+    def read_abvalue(self, request):
+        "AB test groups saved on the request by the handler"
         abvalue_string = request.getHeader(self.config.get('abvalue_header'))
         if abvalue_string:
-            abvalue = dict(value.split(':') for value in abvalue_string.split(','))
+            return dict(value.split(':') for value in abvalue_string.split(','))
         else:
-            abvalue = {}
+            return {}
+        
+    def page_variant(self, response):
+        "The sorted cookies and ab tests a backend response varies on"
+        cookies = sorted((response.getHeader(self.config.get('cookies_header')) or '').split(','))
         abdependency = sorted((response.getHeader(self.config.get('abdependency_header')) or '').split(','))
+        return cookies, abdependency
+
+    def extract_page(self, response, request, waiters=(), started=None, pending=None):
+        self.release_page(pending, waiters)
+        
+        # Extract uniqueness info and AB test dependencies
+        cookies, abdependency = self.page_variant(response)
+        abvalue = self.read_abvalue(request)
 
         key = self.hash_page(request, cookies = cookies, abdependency = abdependency, abvalue = abvalue)
 
         # Store uri variant
         if key not in self.uri_lookup.setdefault(request.uri.rstrip("?"), []):
-            log.msg('Added new variant for %s: %s' % (request.uri.rstrip("?"), key))
+            logs.info('variant', 'Added new variant for %s: %s', request.uri.rstrip("?"), key)
             self.uri_lookup[request.uri.rstrip("?")].append(key)
 
         # Override for non GET's
         if request.method.upper() in self.uncacheable_methods:
-            log.msg('NO-CACHE (Method is %s) [%s]' % (request.method, key))
+            logs.info('policy', 'NO-CACHE (Method is %s) [%s]', request.method, key)
             cache = False
             cache_control = 0
         else:    
-            # Cache logic
-            cache_control = response.getCacheControlHeader(self.config.get('cache_header')) or 0
-            if response.status in self.uncacheable_status:
-                log.msg('NO-CACHE (Status is %s) [%s]' % (response.status, key))
-                cache = False
-            elif response.status in self.short_status:
-                log.msg('SHORT-CACHE (Status is %s) [%s]' % (response.status, key))
-                cache = True
-                cache_control = 30
-            elif cache_control and cache_control > 0:
-                log.msg('CACHE [%s] (for %ss)' % (key, cache_control))
-                cache = True
-            else:
-                log.msg('NO-CACHE (No cache data) [%s]' % key)
-                cache = False
-
-        # Actual return value  
-        value =  {
-            'response' : response,
-            'rendered_on' : time.time(),
-            'cache_control' : cache_control,
-        }
+            cache, cache_control = self.cache_policy(response, key)
+
+        # Actual return value, without what only applied to the backend connection
+        response.removeHopHeaders()
         if cache:
+            response.clearCookies()
+        value = page.Page(response, time.time(), cache_control)
+        if started:
+            value.fetch_time = value.rendered_on - started
+        value.template = template.compile(response.body, self.specialization_re)
+        value.dependencies = template.dependencies(value.template)
+        if cache:
+            self.uri_dependencies[request.uri.rstrip("?")] = value.dependencies
+            self.uri_variants[self.variant_path(request)] = (cookies, abdependency)
             # save page
-            response.cookies = []
+            if self.compressible(response):
+                value.gzip = compress.compile(response.body, value.template)
             self.cache.set({key : value}, cache_control * 10) # 10x cache control length
+        elif request.method.upper() not in self.uncacheable_methods:
+            # Stop making requests for this path wait on each other
+            self.uri_variants.pop(self.variant_path(request), None)
         if abdependency:
             # save abdependency
             abdependency_key = self.hash_abdependency(request)
             self.cache.set({abdependency_key: abdependency}, cache_control * 10)
+        # Hand the page to requests that waited on this one if it is the variant
+        # they would have gotten, otherwise let them fetch their own
+        for waiter, waiter_request in waiters:
+            if cache and key == self.hash_page(waiter_request, cookies = cookies, abdependency = abdependency, abvalue = self.read_abvalue(waiter_request)):
+                waiter.callback(value)
+            else:
+                self.fetch_page(waiter_request, None, coalesce=False).chainDeferred(waiter)
         return value
+
+    def compressible(self, response):
+        "Whether a gzipped copy of a page is worth keeping"
+        content_type = (response.getHeader('content-type') or 'text/html').lower()
+        return self.gzip and \
+            len(response.body) >= self.gzip_min_length and \
+            not response.getHeader('content-encoding') and \
+            (content_type.startswith('text/') or 'javascript' in content_type or 'json' in content_type or 'xml' in content_type)
+
+    def page_template(self, value):
+        "Return the compiled template of a page, compiling it if it was cached without one"
+        if value.template is None:
+            value.template = template.compile(value.body, self.specialization_re)
+        return value.template
+
+    def page_dependencies(self, value):
+        "Return the (element_type, element_id) pairs a page needs to be rendered"
+        if value.dependencies is None:
+            value.dependencies = template.dependencies(self.page_template(value))
+        return value.dependencies
     
     # Memcache
     
@@ -364,18 +587,37 @@ class DataStore:
         #value = result and result[1]
         value = result
         key = self.hash_memcache(request, id)
-        self.cache.set({key: value}, 30) # 30 seconds
+        self.cache_elements({key: value}, 30) # 30 seconds
         return value
         
+    def fetch_multi_memcache(self, request, ids):
+        d = self.proto.get_multi(ids)
+        d.addCallbacks(self.extract_multi_memcache, self.extract_partial,
+            callbackArgs = (request, ids), errbackArgs = (self.hash_memcache, request, ids))
+        return d
+
+    def extract_multi_memcache(self, results, request, ids):
+        output = dict([(id, (results or {}).get(id)) for id in ids])
+        self.cache_elements(dict([(self.hash_memcache(request, id), value) for id, value in output.items()]), 30) # 30 seconds
+        return output
+
+    def extract_partial(self, failure, hash, request, ids):
+        "Cache what the servers that answered returned, without tombstones for the keys of the others"
+        failure.trap(mc.McUnavailable)
+        logs.warning('element', 'Not caching misses: %s', failure.getErrorMessage())
+        found = failure.value.found
+        self.cache.set(dict([(hash(request, id), value) for id, value in found.items()]), 30) # 30 seconds
+        return dict([(id, found.get(id)) for id in ids])
+
     def valid_memcache(self, request, id, value):
         return True
                 
     def incr_memcache(self, key):
-        log.msg('Incrementing memcache %s' % key)
+        logs.debug('element', 'Incrementing memcache %s', key)
         return self.proto.increment(key)
 
     def decr_memcache(self, key):
-        log.msg('Decrementing memcache %s' % key)
+        logs.debug('element', 'Decrementing memcache %s', key)
         return self.proto.decrement(key)
         
     def delete_memcache(self, key):
@@ -383,7 +625,7 @@ class DataStore:
         return self.proto.delete(key)
         
     def set_memcache(self, key, val):
-        log.msg('Setting memcache %s' % key)
+        logs.debug('element', 'Setting memcache %s', key)
         return self.proto.set(key, val)
         
     # Viewdb
@@ -400,20 +642,31 @@ class DataStore:
         #value = result and result[1]
         value = result
         key = self.hash_viewdb(request, id)
-        self.cache.set({key: value}, 30) # 30 seconds
+        self.cache_elements({key: value}, 30) # 30 seconds
         #log.msg('Set twice cache key %s as %s' % (key, value))
         return value
         
+    def fetch_multi_viewdb(self, request, ids):
+        d = self.viewdb.get_multi(ids)
+        d.addCallbacks(self.extract_multi_viewdb, self.extract_partial,
+            callbackArgs = (request, ids), errbackArgs = (self.hash_viewdb, request, ids))
+        return d
+
+    def extract_multi_viewdb(self, results, request, ids):
+        output = dict([(id, (results or {}).get(id)) for id in ids])
+        self.cache_elements(dict([(self.hash_viewdb(request, id), value) for id, value in output.items()]), 30) # 30 seconds
+        return output
+
     def valid_viewdb(self, request, id, value):
         return True
         
     def incr_viewdb(self, key):
-        log.msg('Incrementing viewdb %s' % key)
+        logs.debug('element', 'Incrementing viewdb %s', key)
         self.viewdb.add(key, "0")
         return self.viewdb.increment(key)
 
     def set_viewdb(self, key, val):
-        log.msg('Setting viewdb %s' % key)
+        logs.debug('element', 'Setting viewdb %s', key)
         return self.viewdb.add(key, val)
     
     # viewdb for unread message counts per user
@@ -428,11 +681,8 @@ class DataStore:
         return 'unread_%s' % id
                 
     def extract_unread(self, result, request, id):
-        log.msg("Extracting unread count from %s" % repr(result))
-        if len(result) > 1:
-            value = result and result[1] or "0"
-        else:
-            value = result or "0"
+        logs.debug('element', 'Extracting unread count from %r', result)
+        value = result or "0"
         output = {'count' : value}
         key = self.hash_unread(request, id)
         self.cache.set({key: output}, 60) # one minute
@@ -483,7 +733,7 @@ class DataStore:
     def _session(self, txn, id):
         #log.msg('Looking up session %s' % id)
         users_query = "select * from users where id = %s" % id
-        log.msg('Running query: %s' % users_query)
+        logs.debug('session', 'Running query: %s', users_query)
         txn.execute(users_query)
         users_result = txn.fetchall()
         return [users_result]
@@ -519,7 +769,8 @@ class DataStore:
         return "abvalue_%s" % self.read_ab_cookie(request)
 
     def fetch_abvalue(self, request, ignored=None):
-        log.msg('Looking up ab group: %s' % self.hash_abvalue(request))
+        if logs.enabled(logs.DEBUG, 'abvalue'):
+            logs.output('Looking up ab group: %s', self.hash_abvalue(request))
         if not hasattr(self, 'viewdb'):
             log.msg("Not connected to the viewdb")
             return self.extract_abvalue(None, request)
@@ -530,10 +781,10 @@ class DataStore:
         return True
 
     def extract_abvalue(self, result, request):
-        log.msg("Extracting abvalue from %s" % repr(result))
-        if result and result[1]:
+        logs.debug('abvalue', 'Extracting abvalue from %r', result)
+        if result:
             try:
-                output = pickle.loads(result[1])
+                output = pickle.loads(result)
             except:
                 log.msg("Exceptin depickling result")
                 traceback.print_exc()
@@ -549,14 +800,14 @@ class DataStore:
         self.cache.set({key: output}, 300) # 5 minutes
         if updated and hasattr(self, 'viewdb'):
             self.viewdb.set(key, pickle.dumps(output)) # 30 days
-        log.msg("EXTRACTED ABVALUE %s" % repr(output))
+        logs.debug('abvalue', 'EXTRACTED ABVALUE %r', output)
         return output
 
     def read_ab_cookie(self, request):
         ab_id = request.getCookie(self.config['ab_cookie'])
         if not ab_id:
             ab_id = self.gen_ab_id()
-            log.msg("Generating new ab cookie: %s" % ab_id)
+            logs.debug('abvalue', 'Generating new ab cookie: %s', ab_id)
             request.addCookie(self.config['ab_cookie'], ab_id)
             request.addCookie(self.config['new_ab_cookie'], 'True')
         return ab_id
@@ -0,0 +1,67 @@
+import mail
+
+# A compiled template is a list of expression nodes, in the order they appear
+# in the page body.  Each node is a tuple:
+#
+#   (start, end, command, target, args, filters, expression)
+#
+#   start, end - offsets of the whole tag in the body
+#   command    - one of 'get', 'pop', 'if', 'unless', 'incr', 'decr' (None if
+#                the tag could not be parsed)
+#   target     - one of 'memcache', 'session', 'viewdb', ...
+#   args       - list of arguments, usually the name of a key
+#   filters    - list of filters to apply to the output ('js', 'html', ...)
+#   expression - the stripped text inside the tag
+#
+# Literal text is not stored, it is sliced out of the body between nodes.
+
+def parse(expression):
+    "Parse the text inside a tag into (command, target, args, filters)"
+    # Syntax is: command target arg1 arg2 argn | filter1 filtern
+    parts = expression.split()
+    command, target, args = parts[0].lower(), parts[1], parts[2:]
+    actual_args = []
+    filters = []
+    next_filter = False
+    for arg in args:
+        if arg == "|":
+            next_filter = True
+        elif next_filter:
+            filters.append(arg)
+        else:
+            actual_args.append(arg)
+    return command, target, actual_args, filters
+
+def compile(body, regex):
+    "Scan a page body once and return its list of expression nodes"
+    nodes = []
+    for match in regex.finditer(body):
+        expression = match.groups()[0].strip()
+        try:
+            command, target, args, filters = parse(expression)
+        except:
+            mail.error('Could not parse expression: [%s]' % expression)
+            command, target, args, filters = None, None, [], []
+        nodes.append((match.start(), match.end(), command, target, args, filters, expression))
+    return nodes
+
+def render(body, nodes, evaluate):
+    "Join the literal text of body with evaluate(node) for every node"
+    if not nodes:
+        return body
+    output = []
+    position = 0
+    for node in nodes:
+        output.append(body[position:node[0]])
+        output.append(evaluate(node))
+        position = node[1]
+    output.append(body[position:])
+    return ''.join(output)
+
+def dependencies(nodes):
+    "Return the sorted (element_type, element_id) pairs a compiled template refers to"
+    found = set()
+    for start, end, command, target, args, filters, expression in nodes:
+        if command is not None and args:
+            found.add((target.lower(), args[0]))
+    return sorted(found)
@@ -0,0 +1,200 @@
+from twisted.trial import unittest
+from twisted.internet import reactor
+import os, re, time
+import cache, http, page, template, compress
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.cache = self.open()
+
+    def tearDown(self):
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def open(self):
+        return cache.DiskCache({'cache_disk_path': self.path, 'cache_disk_size': 0.0625, 'cache_codec': 'pickle'})
+
+    def test_shortTTLAndTombstonesSkipped(self):
+        self.cache.set({'a': 'old'}, 600)
+        self.cache.set({'a': 'new'}, 10)
+        self.cache.set({'b': cache.TOMBSTONE}, 600)
+        self.assertEqual(self.cache.get(['a', 'b']), {'a': None, 'b': None})
+
+    def test_compactKeepsChangesMadeMeanwhile(self):
+        self.cache.set({'kept': 'x' * 100, 'deleted': 'y' * 100, 'changed': 'old'}, 600)
+        d = self.cache.compact()
+        self.cache.delete('deleted')
+        self.cache.set({'changed': 'new', 'added': 'z'}, 600)
+        def compacted(result):
+            self.assertEqual(self.cache.compactions, 1)
+            expected = {'kept': 'x' * 100, 'deleted': None, 'changed': 'new', 'added': 'z'}
+            self.assertEqual(self.cache.get(expected.keys()), expected)
+            # The index rebuilt from the new log agrees
+            self.assertEqual(self.open().get(expected.keys()), expected)
+        return d.addCallback(compacted)
+
+class BinaryCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = cache.BinaryCodec()
+
+    def roundTrip(self, value):
+        return self.codec.decode(self.codec.encode(value))
+
+    def test_page(self):
+        response = http.HTTPObject()
+        response.setHeader('content-type', 'text/html')
+        response.body = 'Hi <& get session name | html &>, you have <& get unread count 0 &> messages'
+        value = page.Page(response, time.time(), 60)
+        value.fetch_time = 0.25
+        value.template = template.compile(response.body, re.compile(r'<&(.*?)&>'))
+        value.dependencies = template.dependencies(value.template)
+        value.gzip = compress.compile(response.body, value.template)
+        decoded = self.roundTrip(value)
+        self.assertEqual(decoded.__getstate__(), value.__getstate__())
+
+    def test_templateIsNotParsedAgain(self):
+        value = page.Page(http.HTTPObject(), time.time(), 60)
+        value.body = '<& get memcache key &>'
+        value.template = [(0, 22, 'get', 'memcache', ['key'], [], 'get memcache key')]
+        value.dependencies = [('memcache', 'key')]
+        self.patch(template, 'parse', None)
+        decoded = self.roundTrip(value)
+        self.assertEqual(decoded.template, value.template)
+        self.assertEqual(decoded.dependencies, value.dependencies)
+
+    def test_tombstone(self):
+        self.assertIdentical(self.roundTrip(cache.TOMBSTONE), cache.TOMBSTONE)
+
+    def test_scalars(self):
+        for value in ['text', u'\xe9t\xe9', 42, 2 ** 70, 1.5, True, False, None]:
+            self.assertEqual(self.roundTrip(value), value)
+            self.assertEqual(type(self.roundTrip(value)), type(value))
+
+    def test_dict(self):
+        value = {'count': 3, 'names': ['a', u'b'], 'nested': {'x': None}}
+        self.assertEqual(self.roundTrip(value), value)
+
+    def test_pickleFallback(self):
+        value = (1, set(['a']))
+        self.assertEqual(self.codec.pack(value)[0], 'p')
+        self.assertEqual(self.roundTrip(value), value)
+
+class SharedmemoryCacheTest(unittest.TestCase):
+
+    def open(self, size):
+        return cache.SharedmemoryCache({'cache_shm_path': self.path, 'cache_shm_size': size, 'cache_codec': 'pickle'})
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_sharedBetweenProcesses(self):
+        first, second = self.open(1), self.open(1)
+        first.set({'key': 'value'}, 60)
+        self.assertEqual(second.get(['key']), {'key': 'value'})
+
+    def test_otherLayoutIsReplacedNotTruncated(self):
+        first = self.open(1)
+        first.set({'key': 'value'}, 60)
+        second = self.open(2)
+        # The first mapping is still intact and keeps working
+        self.assertEqual(first.get(['key']), {'key': 'value'})
+        self.assertEqual(second.get(['key']), {'key': None})
+        self.assertEqual(len(first.map), 1024 * 1024)
+
+class Tier(cache.Cache):
+    "Cache tier that records the TTL of every value set in it"
+
+    def __init__(self, values = None):
+        cache.Cache.__init__(self, {})
+        self.values = values or {}
+        self.ttls = {}
+
+    def set(self, dictionary, ttl = None):
+        self.values.update(dictionary)
+        self.ttls.update([(key, ttl) for key in dictionary])
+
+    def get(self, keylist):
+        return dict([(key, self.values.get(key)) for key in keylist])
+
+class TieredCacheTest(unittest.TestCase):
+
+    def tearDown(self):
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def test_backfillKeepsTTLs(self):
+        fresh = page.Page(http.HTTPObject(), time.time(), 10)
+        stale = page.Page(http.HTTPObject(), time.time() - 29, 10)
+        tiered = cache.TieredCache({'cache_tiers': 'null', 'cache_local_ttl': 5, 'cache_backfill_ttl': 60})
+        local, shared = Tier(), Tier()
+        memcache = Tier({'tombstone': cache.TOMBSTONE, 'count': '3', 'fresh': fresh, 'stale': stale})
+        tiered.tiers = [local, shared, memcache]
+        tiered.ttls = [5, None, None]
+        tiered.hits = [0, 0, 0]
+        self.successResultOf(tiered.get(['tombstone', 'count', 'fresh', 'stale']))
+        self.assertEqual(local.ttls, {'tombstone': 5, 'count': 5, 'fresh': 5, 'stale': 5})
+        self.assertEqual(shared.ttls.keys(), ['fresh'])
+        self.assertTrue(29 <= shared.ttls['fresh'] <= 30)
+
+class DiskCacheLockTest(unittest.TestCase):
+
+    def tearDown(self):
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def test_logOfAnotherInstanceIsNotShared(self):
+        path = self.mktemp()
+        first = cache.DiskCache({'cache_disk_path': path, 'cache_disk_size': 0.0625, 'port': 8080})
+        second = cache.DiskCache({'cache_disk_path': path, 'cache_disk_size': 0.0625, 'port': 8081})
+        self.assertNotEqual(first.path, second.path)
+
+    def test_logInUseIsRefused(self):
+        config = {'cache_disk_path': self.mktemp(), 'cache_disk_size': 0.0625}
+        cache.DiskCache(config)
+        # Locks are per process, so the second open has to come from another one
+        pid = os.fork()
+        if not pid:
+            try:
+                cache.DiskCache(config)
+            except IOError:
+                os._exit(0)
+            os._exit(1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+class InternalCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Room for three of the values below
+        self.cache = cache.InternalCache({}, 0.001)
+        self.value = 'x' * (self.cache.max_bytes / 3 - 100)
+
+    def tearDown(self):
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+
+    def test_sizeIsCounted(self):
+        self.cache.set({'a': self.value}, 60)
+        self.assertEqual(self.cache.bytes, cache.approximate_size('a') + cache.approximate_size(self.value))
+        self.cache.set({'a': 'small'}, 60)
+        self.assertEqual(self.cache.bytes, cache.approximate_size('a') + cache.approximate_size('small'))
+        self.cache.delete('a')
+        self.assertEqual(self.cache.stats(), {'keys': 0, 'bytes': 0, 'evictions': 0})
+
+    def test_leastRecentlyUsedIsEvicted(self):
+        self.cache.set({'a': self.value}, 60)
+        self.cache.set({'b': self.value}, 60)
+        self.cache.set({'c': self.value}, 60)
+        # Reading a makes b the least recently used
+        self.cache.get(['a'])
+        self.cache.set({'d': self.value}, 60)
+        self.assertEqual(self.cache.get(['a', 'b', 'c', 'd']), {'a': self.value, 'b': None, 'c': self.value, 'd': self.value})
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertTrue(self.cache.bytes <= self.cache.max_bytes)
+
+    def test_valueLargerThanCacheIsNotStored(self):
+        self.cache.set({'a': self.value}, 60)
+        self.cache.set({'huge': 'x' * self.cache.max_bytes}, 60)
+        self.assertEqual(self.cache.get(['a', 'huge']), {'a': self.value, 'huge': None})
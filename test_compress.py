@@ -0,0 +1,31 @@
+from twisted.trial import unittest
+import re, zlib
+import compress, template
+
+regex = re.compile(r'<&(.*?)&>')
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class RenderTest(unittest.TestCase):
+
+    def check(self, body, values):
+        nodes = template.compile(body, regex)
+        evaluate = lambda node: values.get(node[6], '')
+        expected = template.render(body, nodes, evaluate)
+        self.assertEqual(gunzip(compress.render(body, nodes, compress.compile(body, nodes), evaluate)), expected)
+
+    def test_noTemplate(self):
+        self.check('<html>' + 'static ' * 100 + '</html>', {})
+
+    def test_values(self):
+        self.check('<p>Hi <& get session name &>!</p>' * 20 + '<& get memcache count &> new',
+            {'get session name': 'Ann', 'get memcache count': '12'})
+
+    def test_repeatedAndEmptyValues(self):
+        # Values repeating each other must not be encoded as references across literals
+        body = 'a <& get x y &> b <& get x z &> c <& get x w &>'
+        self.check(body, {'get x y': 'repeat ' * 10, 'get x z': 'repeat ' * 10, 'get x w': ''})
+
+    def test_adjacentTags(self):
+        self.check('<& get x a &><& get x b &>', {'get x a': 'one', 'get x b': 'one'})
@@ -0,0 +1,143 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task, defer
+import http
+
+class Dispatcher(http.HTTPRequestDispatcher):
+    keepalive_timeout = 15
+
+    def __init__(self):
+        self.requests = []
+
+    def objectReceived(self, connection, request):
+        self.requests.append(request)
+        connection.sendCode(200, 'ok')
+
+class HTTPServerTest(unittest.TestCase):
+
+    def connect(self):
+        server = Dispatcher().buildProtocol(None)
+        server.callLater = task.Clock().callLater
+        transport = proto_helpers.StringTransport()
+        server.makeConnection(transport)
+        self.addCleanup(server.setTimeout, None)
+        return server, transport
+
+    def test_persistentResponseIsHTTP11(self):
+        server, transport = self.connect()
+        server.dataReceived('GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        status, headers = transport.value().split('\r\n\r\n')[0].split('\r\n', 1)
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertIn('connection: keep-alive', headers.split('\r\n'))
+
+    def test_closingResponse(self):
+        server, transport = self.connect()
+        server.dataReceived('GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+        headers = transport.value().split('\r\n\r\n')[0].split('\r\n')
+        self.assertIn('connection: close', headers)
+        self.assertTrue(transport.disconnecting)
+
+    def test_pipelinedAfterChunkedBody(self):
+        server, transport = self.connect()
+        server.dataReceived('POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nbody\r\n0\r\n\r\n'
+            'GET /b HTTP/1.1\r\n\r\n')
+        self.assertEqual([(request.uri, request.body) for request in server.factory.requests], [('/a', 'body'), ('/b', '')])
+        self.assertEqual(transport.value().count('HTTP/1.1 200 OK'), 2)
+
+class Pool:
+    def __init__(self):
+        self.released = []
+
+    def release(self, client):
+        self.released.append(client)
+
+class HTTPPooledClientTest(unittest.TestCase):
+
+    def connect(self):
+        pool = Pool()
+        client = http.HTTPPooledClient(pool)
+        transport = proto_helpers.StringTransport()
+        client.makeConnection(transport)
+        return pool, client, transport
+
+    def test_dataWhileIdleClosesConnection(self):
+        pool, client, transport = self.connect()
+        client.dataReceived('HTTP/1.1 408 Request Timeout\r\n\r\n')
+        self.assertTrue(transport.disconnecting)
+
+    def test_extraDataAfterResponseIsNotReused(self):
+        pool, client, transport = self.connect()
+        client.request = http.HTTPObject()
+        client.deferred = d = defer.Deferred()
+        client.dataReceived('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nokjunk')
+        self.assertEqual(self.successResultOf(d).status, 200)
+        self.assertEqual(pool.released, [])
+        self.assertTrue(transport.disconnecting)
+
+class Parser(http.HTTPHandler):
+    "Handler that keeps what it parsed and why it gave up"
+
+    def __init__(self):
+        http.HTTPHandler.__init__(self)
+        self.received = []
+        self.errors = []
+
+    def objectReceived(self, received):
+        self.received.append(received)
+
+    def badObject(self, reason):
+        self.errors.append(reason)
+        http.HTTPHandler.badObject(self, reason)
+
+class HTTPHandlerTest(unittest.TestCase):
+
+    chunked = 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+
+    def parse(self, *pieces):
+        parser = Parser()
+        self.transport = proto_helpers.StringTransport()
+        parser.makeConnection(self.transport)
+        for piece in pieces:
+            parser.dataReceived(piece)
+        return parser
+
+    def test_chunkedByteByByte(self):
+        data = self.chunked + 'a\r\n0123456789\r\n5\r\nabcde\r\n0\r\n\r\n'
+        parser = self.parse(*data)
+        self.assertEqual([response.body for response in parser.received], ['0123456789abcde'])
+        self.assertEqual(parser.received[0].getHeader('content-length'), 15)
+        self.assertEqual(parser.received[0].getHeader('transfer-encoding'), None)
+
+    def test_splitChunkSizeLine(self):
+        parser = self.parse(self.chunked + '1', '0\r', '\n' + 'x' * 16 + '\r\n0\r\n\r\n')
+        self.assertEqual(parser.received[0].body, 'x' * 16)
+
+    def test_chunkExtensions(self):
+        parser = self.parse(self.chunked + '3;name=value\r\nabc\r\n0;last\r\n\r\n')
+        self.assertEqual(parser.received[0].body, 'abc')
+
+    def test_trailersAreIgnored(self):
+        parser = self.parse(self.chunked + '3\r\nabc\r\n0\r\nX-Checksum: 1\r\nX-Other: 2\r\n\r\n')
+        self.assertEqual(parser.received[0].body, 'abc')
+        self.assertEqual(parser.received[0].getHeader('x-checksum'), None)
+        self.assertEqual(parser.errors, [])
+
+    def test_malformedChunkSize(self):
+        parser = self.parse(self.chunked + 'zz\r\nabc\r\n0\r\n\r\n')
+        self.assertEqual(parser.received, [])
+        self.assertEqual(len(parser.errors), 1)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_chunkLongerThanItsSize(self):
+        parser = self.parse(self.chunked + '2\r\nabc\r\n0\r\n\r\n')
+        self.assertEqual(parser.received, [])
+        self.assertEqual(len(parser.errors), 1)
+
+    def test_oversizedHeaders(self):
+        parser = self.parse('GET / HTTP/1.1\r\nX-Big: ' + 'x' * 70000)
+        self.assertEqual(len(parser.errors), 1)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_tooManyHeaders(self):
+        parser = self.parse('GET / HTTP/1.1\r\n' + 'X-Header: 1\r\n' * 101 + '\r\n')
+        self.assertEqual(len(parser.errors), 1)
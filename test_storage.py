@@ -0,0 +1,194 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+import time, re
+import storage, http, page, cache, mc
+
+config = {
+    'template_regex': r'<&(.*?)&>',
+    'cookies_header': 'twice-cookies',
+    'abdependency_header': 'x-abdependency',
+    'abvalue_header': 'x-abvalue',
+    'twice_header': 'x-twice',
+    'cache_header': 'x-twice-control',
+}
+
+class Backend:
+    "Records requests and leaves their responses to the test"
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, request):
+        d = defer.Deferred()
+        self.requests.append((request, d))
+        return d
+
+class Store(storage.DataStore):
+    "DataStore with an in-process cache and a fake backend, without the real backends"
+
+    def __init__(self):
+        self.config = config
+        self.specialization_re = re.compile(config['template_regex'])
+        self.gzip = False
+        self.backend = Backend()
+        self.cache = cache.NullCache({})
+        self.uri_lookup = {}
+        self.uri_limit = 100
+        self.uri_dependencies = storage.BoundedDict(self.uri_limit)
+        self.uri_variants = storage.BoundedDict(self.uri_limit)
+        self.pending_requests = {}
+        self.coalesced_requests = 0
+        self.negative_cache_ttl = 10
+        self.tombstone_hits = 0
+        self.refresher = Refresher()
+        self.xfetch_beta = 0
+
+class Refresher:
+    def hit(self, key, request, value):
+        pass
+
+def request(uri = '/page', method = 'GET'):
+    request = http.HTTPObject()
+    request.method = method
+    request.uri = uri
+    request.setHeader('host', 'example.com')
+    return request
+
+def response(body = 'hello', cache_control = 60):
+    response = http.HTTPObject()
+    response.setHeader('x-twice-control', 'max-age=%s' % cache_control)
+    response.setHeader('content-length', str(len(body)))
+    response.body = body
+    return response
+
+class CoalesceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Store()
+
+    def test_cachedPageTeachesVariant(self):
+        cached = page.Page(response(), time.time() - 1000, 60)
+        self.assertFalse(self.store.valid_page(request(), 'example.com/page', cached))
+        first = self.store.fetch_page(request(), None)
+        second = self.store.fetch_page(request(), None)
+        self.assertEqual(len(self.store.backend.requests), 1)
+        self.store.backend.requests[0][1].callback(response())
+        self.assertEqual(self.successResultOf(second).body, 'hello')
+
+    def test_uncacheableMethodsDoNotCoalesce(self):
+        self.store.uri_variants['/page'] = ([''], [''])
+        self.store.fetch_page(request(), None)
+        self.store.fetch_page(request(method = 'POST'), None)
+        self.assertEqual(len(self.store.backend.requests), 2)
+        self.assertEqual([len(waiters) for waiters in self.store.pending_requests.values()], [0])
+
+    def test_backgroundRefreshesOfUnknownPathsAreDeduplicated(self):
+        self.store.fetch_page(request(), None, ignoreResult = True)
+        self.assertEqual(self.store.fetch_page(request(), None, ignoreResult = True), True)
+        self.assertEqual(len(self.store.backend.requests), 1)
+
+class DictCache(cache.Cache):
+    "Cache that counts its round trips"
+
+    def __init__(self):
+        cache.Cache.__init__(self, {})
+        self.values = {}
+        self.lookups = []
+
+    def set(self, dictionary, ttl = None):
+        self.values.update(dictionary)
+
+    def get(self, keylist):
+        self.lookups.append(keylist)
+        return dict([(key, self.values.get(key)) for key in keylist])
+
+class SpeculationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Store()
+        self.store.cache = DictCache()
+
+    def serve(self, request):
+        "Look a page up the way the handler does, returning the number of cache round trips"
+        lookups = len(self.store.cache.lookups)
+        prefetched = {}
+        abdependency_key = self.store.hash_abdependency(request)
+        d = self.store.get([abdependency_key], request, prefetched = prefetched, speculative = self.store.speculate_page(request))
+        def getPage(elements):
+            key = self.store.hash_page(request, abdependency = elements[abdependency_key] or [], abvalue = {})
+            return self.store.get(key, request, prefetched = prefetched)
+        d.addCallback(getPage)
+        self.assertTrue(self.successResultOf(d).values()[0])
+        return len(self.store.cache.lookups) - lookups
+
+    def test_secondRequestIsOneRoundTrip(self):
+        # Cached by another process, so this one has never fetched it
+        key = self.store.hash_page(request(), cookies = [''], abdependency = [''])
+        self.store.cache.set({key: page.Page(response(), time.time(), 60), self.store.hash_abdependency(request()): ['']})
+        self.assertEqual(self.serve(request()), 2)
+        self.assertEqual(self.serve(request()), 1)
+
+class HopByHopTest(unittest.TestCase):
+
+    def test_backendKeepAliveIsNotReplayed(self):
+        backend = response()
+        backend.setHeader('keep-alive', 'timeout=5')
+        backend.setHeader('connection', 'keep-alive, x-backend-hop')
+        backend.setHeader('x-backend-hop', '1')
+        backend.setHeader('upgrade', 'h2c')
+        value = Store().extract_page(backend, request())
+        server = http.HTTPServer()
+        server.persistent = True
+        server.callLater = task.Clock().callLater
+        server.factory = http.HTTPRequestDispatcher()
+        transport = proto_helpers.StringTransport()
+        server.makeConnection(transport)
+        self.addCleanup(server.setTimeout, None)
+        server.sendResponse(value.response())
+        headers = transport.value().split('\r\n\r\n')[0].lower().split('\r\n')[1:]
+        names = [header.split(':')[0] for header in headers]
+        self.assertNotIn('keep-alive', names)
+        self.assertNotIn('x-backend-hop', names)
+        self.assertNotIn('upgrade', names)
+        self.assertIn('connection: keep-alive', headers)
+
+class Memcache:
+    "Backend memcache client answering get_multi with a prepared result"
+
+    def __init__(self, result):
+        self.result = result
+
+    def get_multi(self, ids):
+        return self.result
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Store()
+        self.store.cache = DictCache()
+
+    def test_confirmedMissesAreTombstoned(self):
+        self.store.proto = Memcache(defer.succeed({'a': '1'}))
+        result = self.successResultOf(self.store.fetch_multi_memcache(request(), ['a', 'b']))
+        self.assertEqual(result, {'a': '1', 'b': None})
+        self.assertEqual(self.store.cache.values, {'memcache_a': '1', 'memcache_b': cache.TOMBSTONE})
+
+    def test_unavailableServersAreNotTombstoned(self):
+        self.store.proto = Memcache(defer.fail(mc.McUnavailable(['b'], {'a': '1'})))
+        result = self.successResultOf(self.store.fetch_multi_memcache(request(), ['a', 'b']))
+        self.assertEqual(result, {'a': '1', 'b': None})
+        self.assertEqual(self.store.cache.values, {'memcache_a': '1'})
+
+class StaleTest(unittest.TestCase):
+
+    def test_staleSoftDoesNotChangeSharedPage(self):
+        store = Store()
+        store.cache = DictCache()
+        rendered_on = time.time() - 90
+        cached = page.Page(response(), rendered_on, 60)
+        self.assertTrue(store.valid_page(request(), 'example.com/page', cached))
+        self.assertEqual(cached.rendered_on, rendered_on)
+        extended = store.cache.values.values()[0]
+        self.assertEqual(extended.rendered_on, rendered_on + 30)
+        self.assertEqual(extended.body, cached.body)
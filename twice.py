@@ -1,6 +1,6 @@
 from twisted.python import log
 from twisted.manhole import telnet
-import sys, os, signal, traceback, resource, socket, mail
+import sys, os, signal, traceback, resource, socket, errno, time, mail, logs
 
 __author__    = "Kyle Vogt <kyle@justin.tv> and Emmett Shear <emmett@justin.tv>"
 __version__   = "0.2"
@@ -31,8 +31,10 @@ class Logger:
 
     def setup_log(self, name):       
         try: 
-            self.log_file = open(name, 'a')
-            self.log_observer = log.FileLogObserver(self.log_file)
+            # Unbuffered, so each batch of lines is a single append even when
+            # several workers write to the file
+            self.log_file = open(name, 'a', 0)
+            self.log_observer = logs.BufferedLogObserver(self.log_file)
             log.startLoggingWithObserver(self.log_observer.emit)
         except:
             msg = "Error in setup_log:\n%s" % traceback.format_exc()
@@ -42,13 +44,118 @@ class Logger:
     def signal_handler(self, signo, frame): 
         try:
             log.msg('Rotating log %s' % self.log_filename)
-            log.removeObserver(self.log_observer.emit)
-            self.log_file.close()
-            self.setup_log(self.log_filename)   
+            self.reopen()
         except:
             msg = "Error in signal_handler:\n%s" % traceback.format_exc()
             print msg
             mail.error(msg)     
+
+    def reopen(self):
+        "Open the log file again, after it was rotated or in a new worker"
+        log.removeObserver(self.log_observer.emit)
+        self.log_observer.flushLines()
+        self.log_file.close()
+        self.setup_log(self.log_filename)
+
+    def start_flushing(self, interval):
+        "Write buffered log lines every interval seconds, once the reactor is installed"
+        from twisted.internet import reactor, task
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.start(interval)
+        reactor.addSystemEventTrigger('after', 'shutdown', self.flush)
+
+    def flush(self):
+        self.log_observer.flushLines()
+
+def listen(port, backlog = 1024):
+    "Listening socket shared by all workers"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+class Supervisor:
+    """Forks worker processes and starts a new one whenever one dies.
+
+    Runs before the reactor is installed.  run() returns the worker number
+    in each worker; the supervisor itself stays in run() until it is told
+    to stop, and passes SIGTERM, SIGINT and SIGUSR1 on to the workers.
+    """
+
+    restart_delay = 1.0
+
+    def __init__(self, count, logger = None):
+        self.count = count
+        self.logger = logger
+        self.workers = {}   # pid -> worker number
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.rotate)
+        for number in xrange(self.count):
+            if self.spawn(number):
+                return number
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            number = self.workers.pop(pid, None)
+            if number is None:
+                continue
+            log.msg('Worker %s (pid %s) exited with status %s' % (number, pid, status))
+            if not self.stopping:
+                time.sleep(self.restart_delay)
+            if not self.stopping and self.spawn(number):
+                return number
+            self.flush()
+        log.msg('All workers stopped')
+        self.flush()
+        sys.exit(0)
+
+    def spawn(self, number):
+        "Fork worker number, returning True in the worker"
+        self.flush()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, self.logger and self.logger.signal_handler or signal.SIG_DFL)
+            if self.logger:
+                # Do not share the supervisor's file object and its buffer
+                self.logger.reopen()
+            return True
+        self.workers[pid] = number
+        log.msg('Started worker %s (pid %s)' % (number, pid))
+        self.flush()
+        return False
+
+    def kill_workers(self, signo):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signo)
+            except OSError:
+                pass
+
+    def stop(self, signo, frame):
+        log.msg('Stopping workers')
+        self.stopping = True
+        self.kill_workers(signal.SIGTERM)
+
+    def rotate(self, signo, frame):
+        if self.logger:
+            self.logger.signal_handler(signo, frame)
+        self.kill_workers(signal.SIGUSR1)
+
+    def flush(self):
+        if self.logger:
+            self.logger.flush()
         
 if __name__ == '__main__':
 
@@ -59,12 +166,22 @@ if __name__ == '__main__':
     config['version'] = __version__
     
     # Log
+    logs.configure(config)
     log_file = config.get('log', 'stdout')
+    logger = None
     if log_file != 'stdout':
         logger = Logger(log_file)
     else:
         log.startLogging(sys.stdout)
 
+    # Fork workers that share one listening socket
+    workers = int(config.get('workers', 1))
+    listener = None
+    config['worker'] = 0
+    if workers > 1:
+        listener = listen(int(config['port']))
+        config['worker'] = Supervisor(workers, logger).run()
+
     # Set up reactor
     try:
         from twisted.internet import epollreactor
@@ -74,6 +191,8 @@ if __name__ == '__main__':
         log.msg('Cannot use epoll!')
         traceback.print_exc()
     from twisted.internet import reactor  
+    if logger:
+        logger.start_flushing(float(config.get('log_flush_interval', 1.0)))
     
     # Step up to maximum file descriptor limit
     try:
@@ -100,7 +219,10 @@ if __name__ == '__main__':
     try:
         import handler
         factory = handler.RequestHandler(config)
-        reactor.listenTCP(int(config['port']), factory)
+        if listener:
+            reactor.adoptStreamPort(listener.fileno(), socket.AF_INET, factory)
+        else:
+            reactor.listenTCP(int(config['port']), factory)
     except:
         mail.error('Error starting handler!\n%s' % traceback.format_exc())
     
@@ -108,8 +230,8 @@ if __name__ == '__main__':
     shell.username = 'twice'
     shell.password = 'twice'
     try:
-        reactor.listenTCP(4040, shell)
-        log.msg('Telnet server running on port 4040.')
+        reactor.listenTCP(4040 + config['worker'], shell)
+        log.msg('Telnet server running on port %s.' % (4040 + config['worker']))
     except:
         log.msg('Telnet server not running.')
             